@@ -13,19 +13,14 @@ topo_list = [jn(INPUT_FOLDER, 'APO', 'R1', 'A2B2_dry.prmtop'),
 	     jn(INPUT_FOLDER, 'HOLO', 'R1', 'A2B2+A769_dry.prmtop'),
 	     jn(INPUT_FOLDER, 'HOLOATP', 'R1', 'A2B2+A769_ATP_dry.prmtop')]
 	      
-selections = ['protein', 'protein not hydrogen', 'backbone || name H HA', 'backbone', 'sidechain', 'sidechain && not hydrogen', ['protein', 'name H N']]
+selections = ['protein', 'protein && not hydrogen', 'backbone || name H HA', 'backbone', 'sidechain', 'sidechain && not hydrogen', ['protein', 'name H N']]
 
 name_sels = ['allH', 'all', 'backboneH', 'backbone', 'sidechainH', 'sidechain', 'amideprot']
 
-L_output = [jn(OUTPUT_FOLDER, selection) for selection in name_sels]
-
 name_list= ['apo', 'holo', 'holoatp']
 
-for replica in range(1,4):
-    for selection, output_folder in zip(selections, L_output):
-        n_cpu = multiprocessing.cpu_count()
-        pool = multiprocessing.Pool(processes=min(n_cpu, len(traj_list)))
-        new_trajlist = [[traj[replica]] for traj in traj_list]
-        print(new_trajlist)
-        L_output_atomic = [jn(OUTPUT_FOLDER, '{0}_{1}.anpy'.format(name, replica)) for name in name_list]
-        networks = pool.starmap(create_aanet_multiselection, zip(new_trajlist, [None]*len(traj_list), topo_list, ['all']*len(traj_list), [5]*len(traj_list), L_output_atomic))
+traj_map = dict(zip(name_list, traj_list))
+topo_map = dict(zip(name_list, topo_list))
+
+if __name__ == '__main__':
+    run_pipeline(traj_map, topo_map, selections, OUTPUT_FOLDER, names=name_sels, baseSelection='all', cutoff=5)
@@ -0,0 +1,42 @@
+"""Import-time benchmark of dynpertnet.
+Imports the module in fresh interpreters, reports the best time and fails (exit
+code 1) if it exceeds the budget or if plotting, clustering or PDB parsing
+dependencies were imported at module load."""
+import sys
+import json
+import argparse
+import subprocess
+
+HEAVY = ['matplotlib', 'seaborn', 'pandas', 'sklearn', 'Bio']
+
+CODE = '''import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in {heavy} if m in sys.modules]]))'''
+
+def measure(module='dynpertnet', repeat=5):
+    """Returns the best import time of module over repeat fresh interpreters and the
+    heavy dependencies it imported"""
+    times, loaded = [], set()
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', CODE.format(module=module, heavy=HEAVY)],
+                             capture_output=True, text=True, check=True).stdout
+        elapsed, heavy = json.loads(out.splitlines()[-1])
+        times.append(elapsed)
+        loaded.update(heavy)
+    return min(times), sorted(loaded)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Guards the import time of dynpertnet')
+    parser.add_argument('--module', type=str, default='dynpertnet', help='module to import')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh imports')
+    parser.add_argument('--max-seconds', type=float, default=1.5, help='import time budget')
+    args = parser.parse_args()
+
+    best, loaded = measure(args.module, args.repeat)
+    print('import {0}: {1:.3f} s (budget {2} s)'.format(args.module, best, args.max_seconds))
+    if loaded:
+        print('Heavy dependencies imported at module load: {0}'.format(', '.join(loaded)))
+    if loaded or best > args.max_seconds:
+        sys.exit(1)
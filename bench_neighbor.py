@@ -0,0 +1,58 @@
+"""Benchmark of the neighbor search engines of the contact extraction.
+Counts the residue contacts of the same frames with a KDTree per frame and with
+a Verlet list, reports the time per frame of each engine and the number of
+Verlet list builds, and fails (exit code 1) if the counts differ. In triclinic
+boxes, pairs at the cutoff can be rounded differently by the engines, so the
+differing counts are only reported."""
+import sys
+import time
+import argparse
+import numpy as np
+from maker import AANet, ResidueCounter, count_contacts, iterchunks, neighbor_search, unitcells
+
+def measure(traj, topo=None, selection='all', cutoff=5, skin=2, stop=None, chunk=1000, pbc=False, repeat=3):
+    """Returns a dict engine -> (best time per frame in s, counts), the search
+    engines of the last repeat and whether the trajectory has triclinic boxes"""
+    selection = selection.replace("not hydrogen", "!(name =~'H.*')")
+    atom_indices, atom2res = AANet().select_atoms(traj, topo, selection)
+    chunks = [(tr.xyz, unitcells(tr, pbc)) for tr in iterchunks(traj, topo, atom_indices, 0, stop, chunk)]
+    n_frames = sum(len(xyz) for xyz, _ in chunks)
+    triclinic = any(boxes is not None and not np.allclose(boxes*(1 - np.eye(3)), 0) for _, boxes in chunks)
+    results, searches = {}, {}
+    for neighbor in ['kdtree', 'verlet']:
+        times = []
+        for _ in range(repeat):
+            counter = ResidueCounter(atom2res, atom2res.max()+1)
+            search = neighbor_search(neighbor, cutoff, skin)
+            start = time.perf_counter()
+            for xyz, boxes in chunks:
+                count_contacts(counter, xyz, cutoff, boxes=boxes, search=search)
+            counts = counter.counts.copy()
+            times.append((time.perf_counter() - start)/n_frames)
+        results[neighbor], searches[neighbor] = (min(times), counts), search
+    return results, searches, triclinic
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the KDTree and Verlet list neighbor searches')
+    parser.add_argument('traj', type=str, help='trajectory')
+    parser.add_argument('--topo', type=str, default=None, help='topology')
+    parser.add_argument('--selection', type=str, default='protein && not hydrogen', help='atom selection')
+    parser.add_argument('--cutoff', type=float, default=5, help='contact cutoff in Angstrom')
+    parser.add_argument('--skin', type=float, default=2, help='Verlet skin in Angstrom')
+    parser.add_argument('--frames', type=int, default=None, help='number of frames')
+    parser.add_argument('--pbc', action='store_true', help='periodic boundary conditions')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timings')
+    args = parser.parse_args()
+
+    results, searches, triclinic = measure(args.traj, args.topo, args.selection, args.cutoff, args.skin, args.frames,
+                                           pbc=args.pbc, repeat=args.repeat)
+    (kdtree, counts), (verlet, verlet_counts) = results['kdtree'], results['verlet']
+    verlet_search = searches['verlet']
+    print('kdtree: {0:.2f} ms/frame'.format(1000*kdtree))
+    print('verlet: {0:.2f} ms/frame, {1} builds over {2} frames, speedup {3:.2f}x'.format(
+          1000*verlet, verlet_search.n_builds, verlet_search.n_frames, kdtree/verlet))
+    differ = np.count_nonzero(counts != verlet_counts)
+    if differ:
+        print('Contact counts differ between the engines for {0} residue pairs'.format(differ))
+        if not triclinic:
+            sys.exit(1)
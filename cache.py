@@ -0,0 +1,100 @@
+"""Content-addressed cache of per-trajectory contact counts.
+Entries are contact files (see contactfile.py) named after a hash of every input
+of the contact computation: a fingerprint of the trajectory and topology files
+(size, modification time and a hash of a few sampled blocks), the base selection,
+the cutoff, the frame range and the kind of counts (atomic or residue). The least
+recently used entries are evicted when the cache exceeds its size budget."""
+import os
+import json
+import hashlib
+from os.path import join as jn
+from contactfile import write_contacts, read_contacts, EXTENSION
+
+SAMPLE_SIZE = 2**16
+
+def fingerprint(path):
+    """Returns a cheap fingerprint of a file: size, modification time and a hash
+    of its first, middle and last blocks"""
+    if path is None:
+        return None
+    stat = os.stat(path)
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for offset in sorted({0, max(0, stat.st_size//2 - SAMPLE_SIZE//2),
+                              max(0, stat.st_size - SAMPLE_SIZE)}):
+            f.seek(offset)
+            sha.update(f.read(SAMPLE_SIZE))
+    return [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+
+class ContactCache():
+    """On disk cache of contact counts with LRU eviction
+    Parameters: folder: str: folder of the cache entries
+    max_bytes: int: size budget of the cache, default: 50 GB
+    """
+    def __init__(self, folder, max_bytes=50*2**30):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, traj, topo, selection, cutoff, kind, start=0, stop=None, **params):
+        """Returns the key of the counts computed with these inputs
+        Parameters: traj: str: path of the trajectory
+        topo: str: path of the topology
+        selection: str: base selection
+        cutoff: number: contact cutoff
+        kind: str: 'atomic' or 'residue'
+        start, stop: int: frame range
+        params: any other parameter changing the counts"""
+        inputs = dict(traj=fingerprint(traj), topo=fingerprint(topo), selection=selection,
+                      cutoff=cutoff, kind=kind, start=start, stop=stop, **params)
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return jn(self.folder, key+EXTENSION)
+
+    def get(self, key):
+        """Returns: (counts, header, arrays) for the key or None if not cached"""
+        path = self.path(key)
+        try:
+            matrix, arrays, header = read_contacts(path)
+        except (OSError, ValueError):
+            return None
+        #Marking the entry as recently used
+        os.utime(path)
+        return matrix, header, arrays
+
+    def put(self, key, matrix, arrays=None, **metadata):
+        """Stores counts (and additional arrays) under the key and evicts old entries
+        if over budget"""
+        path = self.path(key)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        write_contacts(tmp, matrix, arrays=arrays, **metadata)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits its budget"""
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(EXTENSION):
+                #Entries can be evicted by other processes sharing the folder
+                try:
+                    stat = os.stat(jn(self.folder, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(jn(self.folder, name))
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+def get_cache(cache):
+    """Returns a ContactCache from a ContactCache, a folder path or None"""
+    if cache is None or isinstance(cache, ContactCache):
+        return cache
+    return ContactCache(cache)
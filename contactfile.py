@@ -0,0 +1,88 @@
+"""Binary format for atomic and residue contact matrices.
+Layout of a file:
+    MAGIC (8 bytes) | version (uint32) | header length (uint32) | JSON header | arrays
+The JSON header holds the metadata (kind, shape, cutoff, selection, number of
+frames, residue labels, topology path...) and the dtype, shape and offset of each
+array. Arrays (csr indptr/indices/data, atom to residue map, base atom indices) are
+stored raw and aligned, so that they can be opened with np.memmap and shared
+between processes without being read in full."""
+import os
+import json
+import numpy as np
+from scipy.sparse import csr_matrix
+
+MAGIC = b'DPNCONT\x00'
+VERSION = 1
+EXTENSION = '.dpnc'
+ALIGN = 64
+
+def write_contacts(output, matrix, arrays=None, **metadata):
+    """Writes a contact matrix and its metadata
+    Parameters: output: str: path of the file
+    matrix: scipy sparse matrix: contact counts
+    arrays: dict of str: np.array, optional: additional arrays to store
+    metadata: JSON serializable values to store in the header"""
+    matrix = csr_matrix(matrix)
+    arrays = dict(arrays or {})
+    arrays.update({'indptr': matrix.indptr, 'indices': matrix.indices, 'data': matrix.data})
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()
+              if array is not None}
+    header = dict(metadata, shape=list(matrix.shape), arrays={})
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape),
+                                  'offset': offset}
+        offset += -(-array.nbytes // ALIGN)*ALIGN
+    raw = json.dumps(header).encode()
+    #Arrays start on an aligned offset after the header
+    start = -(-(len(MAGIC) + 8 + len(raw)) // ALIGN)*ALIGN
+    raw += b' '*(start - len(MAGIC) - 8 - len(raw))
+    #Written next to output and moved in place, so that an interrupted write never
+    #leaves a truncated file at output
+    tmp = '{0}.{1}.tmp'.format(output, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([VERSION, len(raw)], dtype='<u4').tobytes())
+        f.write(raw)
+        for name, array in arrays.items():
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, output)
+
+def is_contact_file(path):
+    """Returns True if the file at path is in the contact file format"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_header(path):
+    """Returns the JSON header of a contact file and the offset of its arrays"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a contact file'.format(path))
+        version, length = np.frombuffer(f.read(8), dtype='<u4')
+        if version > VERSION:
+            raise ValueError('Contact file version {0} is not supported (max {1})'.format(version, VERSION))
+        header = json.loads(f.read(int(length)))
+    return header, len(MAGIC) + 8 + int(length)
+
+def read_contacts(path, mmap=True):
+    """Reads a contact file
+    Parameters: path: str: path of the file
+    mmap: bool: if True arrays are memory-mapped (read only) instead of read
+    Returns: matrix: csr_matrix, arrays: dict of np.array, header: dict"""
+    header, start = read_header(path)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', shape=shape,
+                                     offset=start + spec['offset'])
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                                       offset=start + spec['offset']).reshape(shape)
+    matrix = csr_matrix((arrays.pop('data'), arrays.pop('indices'), arrays.pop('indptr')),
+                        shape=tuple(header['shape']), copy=False)
+    return matrix, arrays, header
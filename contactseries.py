@@ -0,0 +1,173 @@
+"""On-disk store of per-frame residue contact counts (time series of the networks).
+A store is a folder holding:
+    header.json: number of residues, labels, metadata and segments (trajectories)
+    chunks.bin: compressed chunks of consecutive frames, appended one after another
+    index.npy: one row per chunk: offset, size, first frame, number of frames,
+    number of pairs and item size of the counts
+A chunk holds the union of the residue pairs in contact in its frames, delta
+encoded, and the (pairs, frames) matrix of the number of atomic contacts of each
+pair in each frame, compressed with zlib. Contacts being persistent, the time
+series of a pair compresses well. Reading a frame or a window only decompresses
+the chunks it overlaps."""
+import os
+import json
+import zlib
+import numpy as np
+from os.path import join as jn
+from scipy.sparse import csr_matrix
+
+INDEX_FIELDS = ['offset', 'nbytes', 'first', 'n_frames', 'n_pairs', 'itemsize']
+
+class ContactSeries():
+    """Append-only store of per-frame residue contact counts
+    Parameters: path: str: folder of the store
+    mode: str: 'r' to read, 'a' to append to an existing store (see create)
+    """
+    def __init__(self, path, mode='r'):
+        self.path, self.mode = path, mode
+        with open(jn(path, 'header.json')) as f:
+            self.header = json.load(f)
+        self.n_residues = self.header['n_residues']
+        self.chunk_frames = self.header['chunk_frames']
+        self.index = np.load(jn(path, 'index.npy'))
+        self._buffer, self._cache = [], (None, None)
+
+    @classmethod
+    def create(cls, path, n_residues, labels=None, chunk_frames=256, **metadata):
+        """Creates an empty store and opens it for appending
+        Parameters: n_residues: int: number of residues
+        labels: list of str, optional: residue labels
+        chunk_frames: int: number of frames per chunk
+        metadata: JSON serializable values to store in the header"""
+        os.makedirs(path, exist_ok=True)
+        header = dict(metadata, n_residues=n_residues, labels=labels, chunk_frames=chunk_frames, segments=[])
+        with open(jn(path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+        np.save(jn(path, 'index.npy'), np.zeros((0, len(INDEX_FIELDS)), dtype=np.int64))
+        open(jn(path, 'chunks.bin'), 'wb').close()
+        return cls(path, mode='a')
+
+    @property
+    def n_frames(self):
+        """Number of frames written and buffered"""
+        return int(self.index[:, 3].sum()) + len(self._buffer)
+
+    def add(self, keys):
+        """Appends a frame
+        Parameters: keys: np.array of int: linearized residue pair (i*n_residues + j)
+        of each atomic contact of the frame, as computed by ResidueCounter"""
+        if self.mode != 'a':
+            raise ValueError('ContactSeries {0} is opened read only'.format(self.path))
+        self._buffer.append(np.unique(keys, return_counts=True))
+        if len(self._buffer) >= self.chunk_frames:
+            self.flush()
+
+    def add_segment(self, name, n_frames):
+        """Records that the last n_frames appended come from the trajectory name"""
+        self.flush()
+        self.header['segments'].append([name, self.n_frames - n_frames, n_frames])
+        self.write_header()
+
+    def flush(self):
+        """Compresses the buffered frames into a chunk and appends it"""
+        if not self._buffer:
+            return
+        pairs = np.unique(np.concatenate([keys for keys, _ in self._buffer]))
+        counts = np.zeros((len(pairs), len(self._buffer)), dtype=np.uint32)
+        for frame, (keys, values) in enumerate(self._buffer):
+            counts[np.searchsorted(pairs, keys), frame] = values
+        counts = counts.astype(np.uint8 if counts.max(initial=0) < 2**8 else np.uint16 if counts.max() < 2**16 else np.uint32)
+        deltas = np.diff(pairs, prepend=0).astype(np.uint32)
+        payload = zlib.compress(deltas.tobytes() + counts.tobytes(), 6)
+        with open(jn(self.path, 'chunks.bin'), 'ab') as f:
+            offset = f.tell()
+            f.write(payload)
+        row = [offset, len(payload), self.n_frames - len(self._buffer), len(self._buffer), len(pairs), counts.itemsize]
+        self.index = np.vstack([self.index, np.array([row], dtype=np.int64)])
+        self._buffer = []
+        np.save(jn(self.path, 'index.npy'), self.index)
+
+    def write_header(self):
+        with open(jn(self.path, 'header.json'), 'w') as f:
+            json.dump(self.header, f)
+
+    def truncate(self, n_frames):
+        """Drops the frames after n_frames (e.g. written after a checkpoint). n_frames
+        should be the first frame of a chunk, which is the case after a flush."""
+        self._buffer = []
+        keep = self.index[:, 2] < n_frames
+        if n_frames not in list(self.index[:, 2]) + [self.n_frames]:
+            raise ValueError('Cannot truncate {0} inside a chunk (frame {1})'.format(self.path, n_frames))
+        self.index = self.index[keep]
+        size = int(self.index[-1, 0] + self.index[-1, 1]) if len(self.index) else 0
+        with open(jn(self.path, 'chunks.bin'), 'r+b') as f:
+            f.truncate(size)
+        np.save(jn(self.path, 'index.npy'), self.index)
+        self.header['segments'] = [s for s in self.header['segments'] if s[1] + s[2] <= n_frames]
+        self.write_header()
+
+    def close(self):
+        self.flush()
+        self.write_header()
+
+    def read_chunk(self, i):
+        """Returns the residue pairs and the (pairs, frames) counts of chunk i"""
+        if self._cache[0] == i:
+            return self._cache[1]
+        offset, nbytes, _, n_frames, n_pairs, itemsize = self.index[i]
+        with open(jn(self.path, 'chunks.bin'), 'rb') as f:
+            f.seek(offset)
+            raw = zlib.decompress(f.read(nbytes))
+        pairs = np.cumsum(np.frombuffer(raw[:4*n_pairs], dtype=np.uint32), dtype=np.int64)
+        counts = np.frombuffer(raw[4*n_pairs:], dtype='u{0}'.format(itemsize)).reshape(n_pairs, n_frames)
+        self._cache = (i, (pairs, counts))
+        return pairs, counts
+
+    def chunks(self, start, stop):
+        """Yields (pairs, counts) of the frames [start, stop), chunk by chunk"""
+        first, n = self.index[:, 2], self.index[:, 3]
+        for i in np.flatnonzero((first < stop) & (first + n > start)):
+            pairs, counts = self.read_chunk(i)
+            yield pairs, counts[:, max(start - first[i], 0):min(stop - first[i], n[i])]
+
+    def to_matrix(self, pairs, values):
+        n = self.n_residues
+        return csr_matrix((values, (pairs // n, pairs % n)), shape=(n, n))
+
+    def frame(self, i):
+        """Returns the residue contact counts of frame i as a csr_matrix"""
+        pairs, counts = next(self.chunks(i, i+1))
+        return self.to_matrix(pairs, counts[:, 0].astype(np.int64))
+
+    def window_sum(self, start=0, stop=None):
+        """Returns the residue contact counts summed over the frames [start, stop)"""
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        total = csr_matrix((self.n_residues, self.n_residues), dtype=np.int64)
+        for pairs, counts in self.chunks(start, stop):
+            total = total + self.to_matrix(pairs, counts.sum(axis=1, dtype=np.int64))
+        return total
+
+    def window_average(self, start=0, stop=None):
+        """Returns the average residue contact counts over the frames [start, stop)"""
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        return self.window_sum(start, stop)/max(stop - start, 1)
+
+    def windows(self, length, step=None, start=0, stop=None):
+        """Yields (start, stop, average) over windows of length frames every step frames"""
+        step = step if step else length
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        for begin in range(start, stop - length + 1, step):
+            yield begin, begin + length, self.window_average(begin, begin + length)
+
+    def pair_series(self, i, j, start=0, stop=None):
+        """Returns the number of atomic contacts between residues i and j in each
+        frame of [start, stop), e.g. to compute contact lifetimes or correlations"""
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        key, series = i*self.n_residues + j, []
+        for pairs, counts in self.chunks(start, stop):
+            where = np.searchsorted(pairs, key)
+            if where < len(pairs) and pairs[where] == key:
+                series.append(counts[where].astype(np.int64))
+            else:
+                series.append(np.zeros(counts.shape[1], dtype=np.int64))
+        return np.concatenate(series) if series else np.zeros(0, dtype=np.int64)
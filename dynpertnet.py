@@ -1,40 +1,355 @@
 import networkx as nx
-import pandas as pd 
-import seaborn as sns 
 import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
 import pickle as pkl
-import matplotlib.pyplot as plt
-from sklearn.cluster import Birch
 import multiprocessing
+import time
+import json
+import os
 from os import makedirs as mkdir
 from maker import *
+from residue_coords import ResidueCoords, IGPS_PROJECTION
+from resampling import bootstrap_difference, jackknife_difference
 from itertools import combinations
 from os.path import join as jn
-from Bio.PDB.Polypeptide import aa1, aa3
-from Bio.PDB import PDBParser
-from Bio.PDB.PDBExceptions import PDBConstructionWarning
-import warnings
-warnings.simplefilter('ignore', PDBConstructionWarning)
-three2one = dict(zip(aa3, aa1))
-t2o = lambda X: three2one[X] if X in three2one else X[0] 
+#Plotting (matplotlib), clustering (sklearn, pandas) and PDB parsing (Bio.PDB) are
+#imported in the methods using them, so that building and thresholding networks
+#starts fast and runs headless
+
+def sparse_adjacency(net):
+    """Returns the node labels and the sparse adjacency matrix of a network, with
+    each contact stored once in the upper triangle
+    Parameters: net: AANet or networkx Graph"""
+    if isinstance(net, AANet) and hasattr(net, 'average'):
+        labels = [net.id2label[i] for i in range(len(net.id2label))]
+        mat = coo_matrix(net.average)
+        row, col, data = mat.row, mat.col, mat.data
+    else:
+        net = net.net if isinstance(net, AANet) else net
+        labels = list(net.nodes())
+        index = dict(zip(labels, range(len(labels))))
+        edges = list(net.edges(data='weight', default=1))
+        row = np.fromiter((index[u] for u, _, __ in edges), dtype=np.int64, count=len(edges))
+        col = np.fromiter((index[v] for _, v, __ in edges), dtype=np.int64, count=len(edges))
+        data = np.fromiter((w for _, __, w in edges), dtype=float, count=len(edges))
+    n = len(labels)
+    return labels, csr_matrix((data, (np.minimum(row, col), np.maximum(row, col))), shape=(n, n))
+
+def node_positions(net):
+    """Returns the mean residue positions stored with a network (dict label -> 
+    coordinates in Angstrom), empty if the network was built without them
+    Parameters: net: AANet or networkx Graph"""
+    if isinstance(net, AANet):
+        return net.positions() if getattr(net, 'coords', None) is not None else {}
+    return nx.get_node_attributes(net, 'coords')
+
+def merge_positions(pos1, pos2):
+    """Averages the positions of the residues present in both dicts"""
+    pos = dict(pos1, **pos2)
+    for u in set(pos1) & set(pos2):
+        pos[u] = (np.asarray(pos1[u]) + np.asarray(pos2[u]))/2
+    return pos
+
+def align_labels(labels1, labels2, nodes='union'):
+    """Aligns two lists of node labels
+    Parameters: nodes: str: 'union' keeps all nodes, 'intersection' the common ones
+    Returns: labels: list of the aligned labels, mappings: np.arrays giving the aligned
+    index of each node of labels1 and labels2 (-1 if dropped)"""
+    if nodes == 'union':
+        known = set(labels1)
+        labels = list(labels1) + [node for node in labels2 if node not in known]
+    elif nodes == 'intersection':
+        known = set(labels2)
+        labels = [node for node in labels1 if node in known]
+    else:
+        raise ValueError("nodes should be 'union' or 'intersection', not {0}".format(nodes))
+    index = dict(zip(labels, range(len(labels))))
+    mappings = [np.array([index.get(node, -1) for node in _labels], dtype=np.int64) 
+                for _labels in (labels1, labels2)]
+    return labels, mappings
+
+def reindex(mat, mapping, n):
+    """Moves the entries of a sparse adjacency matrix to aligned node indices,
+    dropping the nodes mapped to -1"""
+    mat = mat.tocoo()
+    row, col = mapping[mat.row], mapping[mat.col]
+    keep = (row >= 0) & (col >= 0)
+    row, col = row[keep], col[keep]
+    return csr_matrix((mat.data[keep], (np.minimum(row, col), np.maximum(row, col))), shape=(n, n))
+
+def edge_samples(net, labels, keys, level='replica'):
+    """Returns the contact counts of the samples of a network on given edges
+    Parameters: net: AANet: its trajectories (level='replica') or its blocks 
+    (level='block', network created with block) are the samples, or list of AANet
+    or networkx Graph: one sample each, weighted equally
+    labels: list of str: node labels of the edges
+    keys: np.array of int: linear index row*n_nodes + col (row <= col) of each edge
+    Returns: values: np.array of shape (samples, edges), frames: np.array of shape (samples,)"""
+    if isinstance(net, AANet):
+        if level == 'replica':
+            samples = net.replicas
+        elif level == 'block':
+            samples = list(zip(net.blocks.counts, net.blocks.frames))
+        else:
+            raise ValueError("level should be 'replica' or 'block', not {0}".format(level))
+        net_labels = [net.id2label[i] for i in range(len(net.id2label))]
+        samples = [(net_labels, counts, n_frames) for counts, n_frames in samples]
+    else:
+        samples = [sparse_adjacency(sample) + (1,) for sample in net]
+    n, order = len(labels), np.argsort(keys)
+    index = dict(zip(labels, range(n)))
+    values = np.zeros((len(samples), len(keys)))
+    for i, (sample_labels, mat, _) in enumerate(samples if len(keys) else []):
+        mapping = np.array([index.get(node, -1) for node in sample_labels], dtype=np.int64)
+        mat = reindex(mat, mapping, n).tocoo()
+        sample_keys = mat.row.astype(np.int64)*n + mat.col
+        where = np.minimum(np.searchsorted(keys[order], sample_keys), len(keys) - 1)
+        found = keys[order][where] == sample_keys
+        values[i, order[where[found]]] = mat.data[found]
+    return values, np.array([n_frames for _, __, n_frames in samples], dtype=float)
+
+
+class PertEdges():
+    """Compact array representation of a perturbation network: COO arrays of the
+    edges (row, col, weight, sign) over an array of node labels.
+    weight is the 'weight' attribute of the edges: signed, or absolute for networks
+    carrying the sign in a 'color' attribute ('r': positive, 'g': negative).
+    """
+    __slots__ = ('labels', 'row', 'col', 'weight', 'sign', 'colored', '_sorted')
+
+    def __init__(self, labels, row, col, weight, sign=None, colored=False):
+        self.labels = np.asarray(labels, dtype=object)
+        self.row, self.col = np.asarray(row, dtype=np.int64), np.asarray(col, dtype=np.int64)
+        self.weight = np.asarray(weight, dtype=float)
+        self.sign = np.where(self.weight < 0, -1, 1).astype(np.int8) if sign is None else np.asarray(sign, dtype=np.int8)
+        self.colored = colored
+        self._sorted = {}
+
+    @classmethod
+    def from_sparse(cls, labels, adj):
+        """Builds the edges from a sparse signed adjacency matrix"""
+        adj = coo_matrix(adj)
+        return cls(labels, adj.row, adj.col, adj.data)
+
+    @classmethod
+    def from_networkx(cls, net):
+        """Builds the edges from a NetworkX graph"""
+        labels = list(net.nodes())
+        index = dict(zip(labels, range(len(labels))))
+        edges = list(net.edges(data=True))
+        row = np.fromiter((index[u] for u, _, __ in edges), dtype=np.int64, count=len(edges))
+        col = np.fromiter((index[v] for _, v, __ in edges), dtype=np.int64, count=len(edges))
+        weight = np.fromiter((d.get('weight', 1) for _, __, d in edges), dtype=float, count=len(edges))
+        colored = len(edges) > 0 and 'color' in edges[0][2]
+        sign = None
+        if colored:
+            sign = np.fromiter((1 if d['color'] == 'r' else -1 for _, __, d in edges), dtype=np.int8, count=len(edges))
+        return cls(labels, row, col, weight, sign, colored)
+
+    def to_networkx(self):
+        """Builds the NetworkX graph of the network"""
+        net = nx.Graph()
+        net.add_nodes_from(self.labels)
+        u, v = self.labels[self.row], self.labels[self.col]
+        if self.colored:
+            colors = np.where(self.sign > 0, 'r', 'g')
+            net.add_edges_from((_u, _v, {'weight': w, 'color': c}) 
+                               for _u, _v, w, c in zip(u, v, self.weight.tolist(), colors))
+        else:
+            net.add_weighted_edges_from(zip(u, v, self.weight.tolist()))
+        return net
+
+    @property
+    def n_nodes(self):
+        return len(self.labels)
+
+    @property
+    def n_edges(self):
+        return len(self.weight)
+
+    @property
+    def signed(self):
+        """Signed weights of the edges"""
+        return np.abs(self.weight)*self.sign
+
+    def sorted_weights(self, absolute=True):
+        """Returns the edge order by increasing absolute (or signed) weight and the 
+        sorted weights, computed once"""
+        if absolute not in self._sorted:
+            weights = np.abs(self.weight) if absolute else self.weight
+            order = np.argsort(weights, kind='stable')
+            self._sorted[absolute] = (order, weights[order])
+            for array in self._sorted[absolute]:
+                array.flags.writeable = False
+        return self._sorted[absolute]
+
+    def threshold(self, threshold):
+        """Returns a ThresholdView of the edges with absolute weight above threshold"""
+        return ThresholdView(self, threshold)
+
+    def subset(self, mask):
+        """Returns the network restricted to the edges in mask, without isolated nodes"""
+        row, col = self.row[mask], self.col[mask]
+        nodes, inverse = np.unique(np.concatenate([row, col]), return_inverse=True)
+        return PertEdges(self.labels[nodes], inverse[:len(row)], inverse[len(row):], 
+                         self.weight[mask], self.sign[mask], self.colored)
+
+
+class ThresholdView():
+    """Immutable view of the edges of a PertEdges with absolute weight strictly
+    above a threshold. The view only holds a boolean mask over the edges, found by
+    bisection in the sorted weights of the base network, so many thresholds can
+    be held at once without copying the network.
+    """
+    __slots__ = ('base', 'threshold', 'mask', '_edges')
+
+    def __init__(self, base, threshold):
+        self.base, self.threshold = base, threshold
+        order, weights = base.sorted_weights()
+        mask = np.zeros(base.n_edges, dtype=bool)
+        mask[order[np.searchsorted(weights, threshold, side='right'):]] = True
+        mask.flags.writeable = False
+        self.mask, self._edges = mask, None
+
+    @property
+    def n_edges(self):
+        return int(np.count_nonzero(self.mask))
+
+    @property
+    def edges(self):
+        """PertEdges of the thresholded network, without isolated nodes"""
+        if self._edges is None:
+            self._edges = self.base.subset(self.mask)
+        return self._edges
+
+
+def component_sweep(edges, thresholds):
+    """Connectivity of a network at many thresholds in a single pass: edges are 
+    sorted once by decreasing weight and added from the top with a union-find
+    structure, and the state is recorded each time a threshold is reached.
+    Parameters: edges: PertEdges, whose sorted signed weights are reused
+    thresholds: array of numbers: edges with weight strictly above are kept
+    Returns: dict of arrays ordered as thresholds: 'n_components' (number of 
+    connected components, isolated nodes excluded), 'n_isolated' (number of 
+    isolated nodes) and 'largest' (size of the largest component)"""
+    thresholds = np.asarray(thresholds, dtype=float)
+    order, weights = edges.sorted_weights(absolute=False)
+    order, weights = order[::-1], weights[::-1]
+    row, col = edges.row[order].tolist(), edges.col[order].tolist()
+    #Number of edges with weight strictly above each threshold
+    stops = np.searchsorted(-weights, -thresholds, side='left')
+    n = edges.n_nodes
+    parent, size, active = list(range(n)), [1]*n, [False]*n
+    n_active, n_compo, largest, added = 0, 0, 0, 0
+    result = np.zeros((len(thresholds), 3), dtype=np.int64)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for k in np.argsort(stops, kind='stable'):
+        for e in range(added, stops[k]):
+            u, v = row[e], col[e]
+            for node in (u, v):
+                if not active[node]:
+                    active[node] = True
+                    n_active += 1
+                    n_compo += 1
+                    largest = max(largest, 1)
+            ru, rv = find(u), find(v)
+            if ru != rv:
+                if size[ru] < size[rv]:
+                    ru, rv = rv, ru
+                parent[rv] = ru
+                size[ru] += size[rv]
+                largest = max(largest, size[ru])
+                n_compo -= 1
+        added = max(added, stops[k])
+        result[k] = n_compo, n - n_active, largest
+    return {'threshold': thresholds, 'n_components': result[:,0], 
+            'n_isolated': result[:,1], 'largest': result[:,2]}
+
+
+def format_rows(line, data):
+    """Formats each row of a 2D array with the % format line in a single call"""
+    if len(data) == 0:
+        return ''
+    return (line*len(data)) % tuple(data.ravel().tolist())
+
+def vmd_commands(coords, row, col, radii, sign, node_radius):
+    """Returns the VMD (tcl) commands drawing a network: edges as cylinders grouped
+    by color (red: positive, blue: negative sign) and nodes as silver spheres.
+    Parameters: coords: np.array of shape (n_nodes, 3): positions of the nodes
+    row, col: np.arrays: nodes of each edge
+    radii: np.array: radius of each edge
+    sign: np.array: sign of each edge
+    node_radius: number: radius of the nodes"""
+    commands = ['draw delete all \n']
+    for color, group in (('red', sign >= 0), ('blue', sign < 0)):
+        if group.any():
+            commands.append('draw color {0} \n'.format(color))
+            data = np.column_stack([coords[row[group]], coords[col[group]], radii[group]])
+            commands.append(format_rows('draw cylinder { %.3f %.3f %.3f } { %.3f %.3f %.3f } radius %.4f \n', data))
+    commands.append('draw color silver \n')
+    data = np.column_stack([coords, np.full(len(coords), node_radius)])
+    commands.append(format_rows('draw sphere { %.3f %.3f %.3f } radius %s \n', data))
+    return ''.join(commands)
 
 
 class DynPertNet():
-    """Class handling dynamical perturbation networks"""
+    """Class handling dynamical perturbation networks. The network is stored as
+    edge arrays (edges, a PertEdges) and the NetworkX graph (net) is only built 
+    when used. net is a view: modify the network through the methods."""
     def __init__(self):
-        pass
-
-    def create(self, net1, net2):
-        net1 = self.smart_loader(net1)
-        net2 = self.smart_loader(net2)
-        id2label = dict(zip(range(len(net1.nodes())), list(net1.nodes())))
-        pn_signed_adj = nx.to_numpy_array(net2) - nx.to_numpy_array(net1)
-        self.net = nx.from_numpy_array(pn_signed_adj)
-        self.net = nx.relabel_nodes(self.net, id2label)
-
-    def smart_loader(self, net):
+        self._net, self.view = None, None
+
+    @property
+    def edges(self):
+        """PertEdges of the network at the current threshold"""
+        return self.view.edges if self.view else self.base
+
+    @edges.setter
+    def edges(self, value):
+        self.base, self.view, self._net = value, None, None
+
+    @property
+    def net(self):
+        """NetworkX view of the network at the current threshold"""
+        if self._net is None:
+            self._net = self.edges.to_networkx()
+        return self._net
+
+    @net.setter
+    def net(self, value):
+        self.edges = PertEdges.from_networkx(value)
+        self._net = value
+        pos = node_positions(value)
+        if pos:
+            self.pos_3D = pos
+
+    def create(self, net1, net2, nodes='union'):
+        """Creates the perturbation network net2 - net1, nodes being aligned by label
+        Parameters: net1, net2: AANet, networkx Graph or path of a pickled graph
+        nodes: str: 'union' (default) or 'intersection' of the nodes of both networks
+        """
+        net1, net2 = self.smart_loader(net1, graph=False), self.smart_loader(net2, graph=False)
+        labels1, adj1 = sparse_adjacency(net1)
+        labels2, adj2 = sparse_adjacency(net2)
+        labels, (map1, map2) = align_labels(labels1, labels2, nodes)
+        n = len(labels)
+        adj = reindex(adj2, map2, n) - reindex(adj1, map1, n)
+        adj.eliminate_zeros()
+        self.edges = PertEdges.from_sparse(labels, adj)
+        #Mean residue positions accumulated while computing the contacts
+        pos = merge_positions(node_positions(net1), node_positions(net2))
+        if pos:
+            self.pos_3D = pos
+
+    def smart_loader(self, net, graph=True):
         if type(net) == AANet:
-            return net.net
+            return net.net if graph else net
         elif type(net) == nx.classes.graph.Graph:
             return net
         elif type(net) == str:
@@ -46,7 +361,11 @@ class DynPertNet():
     def save(self, output):
         """Parameters: path: str
         Saves the network at the given path"""
-        nx.write_gpickle(self.net, output)
+        net = self.net
+        if getattr(self, 'pos_3D', None):
+            nx.set_node_attributes(net, {u: np.asarray(self.pos_3D[u], dtype=np.float32)
+                                         for u in net.nodes() if u in self.pos_3D}, 'coords')
+        nx.write_gpickle(net, output)
 
     def load(self, input):
         """Parameters: path: str
@@ -54,23 +373,27 @@ class DynPertNet():
         self.net = nx.read_gpickle(input)
         self.method=None
 
+    def threshold(self, threshold):
+        """Parameters: threshold: number
+        Returns a ThresholdView of the full network, keeping the edges with absolute
+        weight above threshold. The network itself is not modified."""
+        return self.base.threshold(threshold)
+
     def apply_threshold(self, threshold):
         """Parameters: threshold: number
-        Makes a copy of the network and applies a threshold to the network"""
+        Applies a threshold to the full network. The network is not copied: the 
+        thresholded network is a view of the full one, restored by reset"""
         print('Applying threshold {0} on network.'.format(threshold))
         self.current_threshold = threshold
         if threshold != None:
-            self.copy = self.net.copy()
-            edgelist_to_remove = [(u,v) for u, v in self.net.edges() 
-            if abs(self.net.edges()[(u,v)]['weight']) <= threshold]
-            self.net.remove_edges_from(edgelist_to_remove)
-            self.net.remove_nodes_from(list(nx.isolates(self.net)))   
+            self.view = self.threshold(threshold)
+            self._net = None
 
     def reset(self):
         """ Resets the network to its orginal copy 
         """
         print('Network reset to its original copy')
-        self.net = self.copy.copy()
+        self.view, self._net = None, None
         self.current_threshold = None
         self.method = None
 
@@ -81,9 +404,12 @@ class DynPertNet():
         -- tail: Selects the x last percent of edges in the graph 
         (kwargs: tail: number, proportion of edges to keep, default: 0.01)
         -- cluster: Selects the top clusters with max x edges 
-        (kwargs: max_edges: int, number of max edges to keep, default: 50)
+        (kwargs: max_edges: int, number of max edges to keep, default: 50,
+        engine: str, 'birch' or 'sweep', default: 'birch', threshold: number, default: 0.5)
         -- component: Selects the edges based on a convex component analysis
         (kwargs: eps: number, precision on the optimal threshold, default: 0.1)
+        -- significance: Keeps the edges above all non significant ones, needs resample
+        (kwargs: alpha: number, significance level, default: 0.05)
         Returns: threshold, number
         """
         if method=='tail':
@@ -92,73 +418,142 @@ class DynPertNet():
             return self.cluster(**kwargs)
         elif method=='component':
             return self.component(**kwargs)
+        elif method=='significance':
+            return self.significance(**kwargs)
         else:
             return None
 
-    def tail(self, tail=0.01):
-        _, __ = plt.subplots(1,1)
-        edges_weight = [self.net[u][v]['weight'] for u, v in self.net.edges()]
-        df = pd.DataFrame({'weight':edges_weight})
-        g = sns.ecdfplot(data=df, x='weight', complementary=True, stat='proportion', ax=__)
-        line = np.array(g.lines[0].get_data())
-        intersection = line[0][np.argwhere(np.diff(np.sign(line[1]-tail)))]
-        plt.close(_)
-        return intersection[0][0]
-
-    def cluster(self, max_edges=50):
-        weights = np.array([self.net.edges()[(u,v)]['weight'] 
-        for (u, v) in self.net.edges()]).reshape(-1, 1)
-
-        birch = Birch(n_clusters=None).fit(weights)
-        labels = birch.predict(weights)
-
-        num_labels = np.max(labels)+1
-
-        order = np.argsort(weights[:,0])
+    def tail(self, tail=0.01, absolute=False):
+        """Parameters: tail: number: proportion of edges to keep
+        absolute: bool: if True, uses the absolute weights instead of the signed ones
+        Returns the weight where the complementary ECDF of the weights crosses tail,
+        i.e. the step of the ECDF line plotted by seaborn's ecdfplot where it does."""
+        _, weights = self.edges.sorted_weights(absolute)
+        n = len(weights)
+        #Complementary ECDF at -inf and after each sorted weight
+        ecdf = 1. - np.arange(n+1)/n
+        crossings = np.flatnonzero(np.diff(np.sign(ecdf - tail)))
+        if len(crossings) == 0:
+            return None
+        k = crossings[0]
+        if k == 0:
+            return -np.inf
+        return weights[k-1]
+
+    def cluster(self, max_edges=50, engine='birch', threshold=0.5):
+        """Parameters: max_edges: int: maximal number of edges to keep
+        engine: str: 'birch' clusters the weights with sklearn's Birch, 'sweep' 
+        clusters the sorted weights from the top, a cluster growing until its 
+        radius would exceed threshold (only the top max_edges+1 weights are swept)
+        threshold: number: maximal radius of a cluster, Birch's threshold
+        Returns the minimal weight of the lowest top cluster such that the top 
+        clusters hold at most max_edges edges"""
+        if engine == 'sweep':
+            return self.cluster_sweep(max_edges, threshold)
+        elif engine != 'birch':
+            raise ValueError("engine should be 'birch' or 'sweep', not {0}".format(engine))
+        from sklearn.cluster import Birch
+        weights = self.edges.weight.reshape(-1, 1)
+
+        #Labels of the fitted data are the predicted ones
+        labels = Birch(threshold=threshold, n_clusters=None).fit(weights).labels_
+
+        #Minimal weight and size of each cluster
+        order = np.argsort(labels, kind='stable')
         ordered_labels = labels[order]
-        ordered_weights = weights[order]
-
-        thresh = []
-        num_elements = []
-        for label in range(num_labels):
-            id_label = ordered_labels == label
-            _weights = ordered_weights[id_label]
-            X = np.where(ordered_labels == label)
-            thresh.append(min(_weights)[0])
-            num_elements.append(X[0].shape[0])
-
-        cumsum_elements = np.cumsum(np.sort(np.array(num_elements)))
-        df = pd.DataFrame({'Label': range(num_labels), 
-                            'Threshold': thresh, 
-                            'Number of elements': num_elements}).sort_values(
-                                by=['Threshold'], 
-                                ascending=False)
-
-        df['Cumulative'] = cumsum_elements
-        frontier_row = df.loc[df['Cumulative']<=max_edges].iloc[-1:]
-        sugg_thresh = frontier_row['Threshold'].values
-        if len(sugg_thresh) == 0:
+        starts = np.flatnonzero(np.r_[True, ordered_labels[1:] != ordered_labels[:-1]])
+        thresh = np.minimum.reduceat(weights[order, 0], starts)
+        num_elements = np.diff(np.r_[starts, len(labels)])
+
+        #Clusters by decreasing threshold, against the cumulated sorted sizes
+        cumsum_elements = np.cumsum(np.sort(num_elements))
+        thresh = thresh[np.argsort(-thresh, kind='stable')]
+        frontier = np.flatnonzero(cumsum_elements <= max_edges)
+        if len(frontier) == 0:
             return None
         else:
-            return sugg_thresh[0]
+            return thresh[frontier[-1]]
+
+    def cluster_sweep(self, max_edges=50, threshold=0.5):
+        """Sweep engine of cluster, see cluster. Sorted 1D data makes Birch's rule
+        (a point joins a cluster if the radius stays below threshold) a single pass,
+        whose clusters have the widths of Birch's ones."""
+        _, weights = self.edges.sorted_weights(absolute=False)
+        if len(weights) == 0:
+            return None
+        #Top max_edges+1 weights by decreasing order
+        k = min(max_edges+1, len(weights))
+        top = weights[len(weights)-k:][::-1]
+        if len(weights) <= max_edges:
+            return top[-1]
+        #Clusters ending before position max_edges hold at most max_edges edges.
+        #Radius from the count, sum and sum of squares of the cluster, as in Birch
+        last, n, total, squares = None, 0, 0., 0.
+        for i, weight in enumerate(top.tolist()):
+            if n and (squares + weight**2)/(n + 1) - ((total + weight)/(n + 1))**2 > threshold**2:
+                last, n, total, squares = i - 1, 0, 0., 0.
+            n, total, squares = n + 1, total + weight, squares + weight**2
+        return None if last is None else top[last]
+
+    def component_profile(self, eps=0.1):
+        """Parameters: eps: number: step between thresholds
+        Returns the connectivity of the network at thresholds 0, eps, 2*eps... up to 
+        the maximal weight, as a dict of arrays (see component_sweep)"""
+        thresholds = []
+        if self.edges.n_edges:
+            thresh, top = 0, np.max(self.edges.weight)
+            while True:
+                thresholds.append(thresh)
+                if top <= thresh:
+                    break
+                thresh += eps
+        return component_sweep(self.edges, thresholds)
 
     def component(self, eps=0.1):
-        thresh = 0
-        n_compo = []
-        _net = self.net.copy()
-        while len(_net.edges()) !=0:
-            for u, v in _net.edges():
-                if _net.edges()[(u, v)]['weight'] <= thresh:
-                    _net.remove_edge(u,v)
-            _net.remove_nodes_from(list(nx.isolates(_net)))
-            n_compo.append(nx.number_connected_components(_net))
-            thresh += eps
-        n_compo = np.array(n_compo)
+        n_compo = self.component_profile(eps)['n_components']
         mean = np.mean(n_compo)
         std = np.std(n_compo)
         extra = n_compo <= mean+std     
         return np.where(extra==False)[0][-1]*eps+1
 
+    def resample(self, samples1, samples2, method='bootstrap', level='replica', n_samples=1000, seed=None):
+        """Computes the distribution of the perturbation weight of each edge by resampling
+        the samples (replicas or blocks of frames) of both networks and attaches the 
+        arrays weight_mean, weight_std and pvalue, aligned with the edges of the full 
+        network (see statistics for the current threshold)
+        Parameters: samples1, samples2: AANet or list of AANet or networkx Graph: 
+        samples of the networks the perturbation network was created from (see edge_samples)
+        method: str: 'bootstrap' or 'jackknife'
+        level: str: 'replica' or 'block', samples of AANets
+        n_samples: int: number of bootstrap resamplings
+        seed: int, optional: seed of the bootstrap"""
+        base = self.base
+        keys = np.minimum(base.row, base.col)*base.n_nodes + np.maximum(base.row, base.col)
+        values1, frames1 = edge_samples(samples1, base.labels, keys, level)
+        values2, frames2 = edge_samples(samples2, base.labels, keys, level)
+        if method == 'bootstrap':
+            stats = bootstrap_difference(values1, frames1, values2, frames2, n_samples, seed)
+        elif method == 'jackknife':
+            stats = jackknife_difference(values1, frames1, values2, frames2)
+        else:
+            raise ValueError("method should be 'bootstrap' or 'jackknife', not {0}".format(method))
+        self.weight_mean, self.weight_std, self.pvalue = stats
+
+    def statistics(self):
+        """Returns the dict of the resampling statistics (mean, std, pvalue) of the
+        edges at the current threshold, in the order of edges"""
+        mask = self.view.mask if self.view else slice(None)
+        return {'mean': self.weight_mean[mask], 'std': self.weight_std[mask], 'pvalue': self.pvalue[mask]}
+
+    def significance(self, alpha=0.05):
+        """Parameters: alpha: number: significance level
+        Returns the smallest threshold keeping only edges of p-value below alpha, i.e.
+        the largest absolute weight of the non significant edges"""
+        if getattr(self, 'pvalue', None) is None:
+            raise ValueError('No p-values: call resample first')
+        weights = np.abs(self.base.weight)[self.pvalue >= alpha]
+        return weights.max() if len(weights) else 0
+
     def apply_optimal_threshold(self, method, **kwargs):
         threshold = self.get_optimal_threshold(method, **kwargs)
         if threshold == None:
@@ -169,16 +564,17 @@ class DynPertNet():
         self.apply_threshold(threshold)
 
     def get_pos_2D(self, pdb_path):
-        structure = PDBParser().get_structure('X', pdb_path)[0]
-        pos = {}
-        for atom in structure.get_atoms():
-            if atom.id == 'CA':
-                residue = atom.parent
-                "these values represents the 2D projection of IGPS in our classical view"
-                y = (0.1822020302*atom.coord[0] + 0.6987674421*atom.coord[1] - 0.6917560857*atom.coord[2])
-                x = 0.9980297273*atom.coord[0]+ 0.0236149631*atom.coord[1]+ 0.05812914*atom.coord[2]
-                pos[t2o(residue.resname)+str(residue.id[1])+':'+residue.parent.id] = (x, y)    
-        self.pos_2D = pos
+        """2D projection of the CA atoms of the structure in our classical view of IGPS"""
+        index = ResidueCoords.from_pdb(pdb_path)
+        self.pos_2D = index.positions(index.project(IGPS_PROJECTION))
+
+    def project_pos_3D(self, matrix=IGPS_PROJECTION):
+        """2D projection of the 3D positions of the network (e.g. the mean positions
+        computed with the contacts)"""
+        labels = list(self.pos_3D)
+        coords = np.array([np.array(self.pos_3D[u].split(), dtype=float) if type(self.pos_3D[u]) == str
+                           else self.pos_3D[u] for u in labels], dtype=float).reshape(-1, 3)
+        self.pos_2D = ResidueCoords(labels, coords).positions(coords @ np.asarray(matrix).T)
 
     def load_pos_2D(self, path):
         self.pos_2D = pkl.load(open(path, 'rb'))
@@ -191,6 +587,7 @@ class DynPertNet():
         PertNet
         iterations: int: Number of iterations to spring the nodes, default=5
         """
+        import matplotlib.pyplot as plt
         if ax == None:
             ax = plt.gca()
         
@@ -202,8 +599,12 @@ class DynPertNet():
         else:
             ax.set_title("Network at threshold {0}".format(self.current_threshold))
 
-        if not self.pos_2D:
-            self.pos_2D(pdb_path)
+        if not getattr(self, 'pos_2D', None):
+            if pdb_path is None and getattr(self, 'pos_3D', None):
+                #Projecting the mean positions stored with the network
+                self.project_pos_3D()
+            else:
+                self.get_pos_2D(pdb_path)
                   
         #Springing nodes
         nodes = self.net.nodes()
@@ -229,13 +630,11 @@ class DynPertNet():
                                 ax=ax
                             )
         #Handling edges
-        colors = [self.net.edges()[(u, v)]['color'] for u, v in self.net.edges()]
-        # convert_colors = lambda color: 'b' if color == 'g' else 'l'
-        # print(np.apply_along_axis(convert_colors, 0, colors.reshape(-1, 1)))
-        # print(colors)
-        colors = list(map(lambda x: 'b' if x=='g' else 'r', colors))
+        edges = self.edges
+        colors = np.where(edges.sign < 0, 'b', 'r')
         nx.draw_networkx_edges(self.net, 
                                 pos=_pos, 
+                                edgelist=list(zip(edges.labels[edges.row], edges.labels[edges.col])),
                                 width=5, 
                                 alpha=1,
                                 edge_color=colors,
@@ -243,15 +642,9 @@ class DynPertNet():
                                 )
 
     def get_pos_3D(self, pdb_path):
-        structure = PDBParser().get_structure('X', pdb_path)[0]
-        node2CA = {}
-        for atom in structure.get_atoms():
-            if atom.id == 'CA':
-                residue = atom.parent
-                coords = ' '.join(map(str, atom.coord))
-                node2CA[t2o(residue.resname)+str(residue.id[1])+':'+residue.parent.id] = coords
-        
-        self.pos_3D = node2CA
+        """Coordinates of the CA atoms of the structure"""
+        index = ResidueCoords.from_pdb(pdb_path)
+        self.pos_3D = dict(zip(index.labels, index.coords))
 
     def to_vmd(self, output, pdb_path=None, norm=1.5, same=False):
         """Outputs a .tcl script to use in vmd to load the network on the
@@ -269,36 +662,25 @@ class DynPertNet():
         if not hasattr(self, 'pos_3D'):
             self.get_pos_3D(pdb_path)
 
-        output = open(output, 'w')
-        output.write('draw delete all \n')
+        edges = self.edges
+        weights = np.abs(edges.weight)
         if not same:
-            div = max(nx.get_edge_attributes(self.net, 'weight').values())/norm  
+            div = max(weights)/norm  
         elif not self.same:
-            self.div = max(nx.get_edge_attributes(self.net, 'weight').values())/norm
+            self.div = max(weights)/norm
             div = self.div
         else:
             div = self.div 
 
-        #Drawing edges
-
-        color = lambda x: 'blue' if x=='g' else 'red'
-        previous = None
-
-        for u, v in self.net.edges():
-            c = color(self.net.get_edge_data(u, v)['color'])
-            if previous != c:
-                output.write('draw color {0} \n'.format(c))
-                previous = c
-            radius = self.net.get_edge_data(u, v)['weight']/div
-            output.write('draw cylinder {'+self.pos_3D[u]+' } { '+self.pos_3D[v]+' } radius '+str(radius)+' \n')
-        
-        #Drawing nodes
-        output.write('draw color silver \n')
-        for u in self.net.nodes():
-            output.write('draw sphere { '+self.pos_3D[u]+' } radius '+str(norm)+' \n')
-        output.close()
+        #Positions computed by older versions are stored as strings
+        coords = np.array([np.array(self.pos_3D[u].split(), dtype=float) if type(self.pos_3D[u]) == str 
+                           else self.pos_3D[u] for u in edges.labels], dtype=float).reshape(-1, 3)
+        script = vmd_commands(coords, edges.row, edges.col, weights/div, edges.sign, norm)
+        with open(output, 'w') as f:
+            f.write(script)
     
     def line_draw(self, ax=None, quantity='weight', title=None):
+        import matplotlib.pyplot as plt
 
         if ax == None:
             ax = plt.gca()
@@ -306,42 +688,82 @@ class DynPertNet():
         if title == None:
             title = str(quantity).capitalize()
 
+        edges = self.edges
         if quantity == 'absweight':
-            adjacency = nx.to_numpy_matrix(self.net)
-            q = np.sum(adjacency, axis=-1)/2
+            values = np.abs(edges.weight)
 
         else:
             if quantity != 'weight': 
                 print("""Quantity to plot in line draw not recognized, 
                 computing weights instead""")
-            adjacency = nx.to_numpy_matrix(self.net)
-            colors = nx.get_edge_attributes(self.net, 'color')
-            sign = {edge: 2*(colors[edge] == 'r') - 1 for edge in colors}
-            nx.set_edge_attributes(self.net, sign, 'sign')
-            signs = nx.to_numpy_matrix(self.net, weight='sign')
-            adjacency = np.multiply(adjacency,signs)
-            q = np.sum(adjacency, axis=-1)/2
-
-        ids = [int(node[1:-2]) for node in self.net.nodes()]
+            values = edges.signed
+        #Each edge counts for both of its nodes, self loops once
+        loop = edges.row == edges.col
+        q = (np.bincount(edges.row, values, minlength=edges.n_nodes) + 
+             np.bincount(edges.col[~loop], values[~loop], minlength=edges.n_nodes))/2
+
+        ids = [int(node[1:-2]) for node in edges.labels]
         ax.set_title(title)
         ax.plot(ids, q, color='k')
         ax.set_xlabel('Residue number')
         return ids, q
             
-def create_dpn(traj1, traj2, topo=None, topo1=None, topo2=None, selection='all', cutoff=5, out1=None, out2=None):
+def create_dpn(traj1, traj2, topo=None, topo1=None, topo2=None, selection='all', cutoff=5, out1=None, out2=None, cache=None,
+               pbc=False, neighbor='kdtree', skin=2):
     if topo:
         topo1, topo2 = topo, topo
-    aanet1 = create_aanet(traj1, topo=topo1, selection=selection, cutoff=cutoff)
+    aanet1 = create_aanet(traj1, topo=topo1, selection=selection, cutoff=cutoff, cache=cache, pbc=pbc, neighbor=neighbor,
+                          skin=skin)
     if out1:
         aanet1.save(out1)
-    aanet2 = create_aanet(traj2, topo=topo2, selection=selection, cutoff=cutoff)
+    aanet2 = create_aanet(traj2, topo=topo2, selection=selection, cutoff=cutoff, cache=cache, pbc=pbc, neighbor=neighbor,
+                          skin=skin)
     if out2:
         aanet2.save(out2)
     dpn = DynPertNet()
     dpn.create(aanet1, aanet2)
     return dpn
  
-def create_dpn_parallel(traj_list, topo_list, selection='all', cutoff=5, output_folder=None, name_list=None):
+def windowed_dpns(aanet1, aanet2=None, length=1, step=None, reference='average'):
+    """Builds the series of perturbation networks over windows of the trajectories, 
+    from the blocks summed in one pass by AANet.create (or create_atomic) with block
+    Parameters: aanet1, aanet2: AANet created with block (aanet2 is optional)
+    length: int: length of the windows in blocks
+    step: int, optional: step between windows in blocks, default: length
+    reference: str: 'average': each window of aanet2 (of aanet1 if aanet2 is None) is
+    compared to the average of aanet1, 'windows': each window of aanet2 is compared to 
+    the window of aanet1 at the same position
+    Returns: list of DynPertNet, their window attribute giving the first frame and 
+    number of frames of the perturbed window"""
+    windows2 = (aanet2 if aanet2 else aanet1).windows(length, step)
+    if reference == 'average':
+        windows1 = [aanet1]*len(windows2)
+    elif reference == 'windows':
+        windows1 = aanet1.windows(length, step)
+    else:
+        raise ValueError("reference should be 'average' or 'windows', not {0}".format(reference))
+    dpns = []
+    for window1, window2 in zip(windows1, windows2):
+        dpn = DynPertNet()
+        dpn.create(window1, window2)
+        dpn.window = window2.window
+        dpns.append(dpn)
+    return dpns
+
+def create_dpn_windows(traj1, traj2, block, topo=None, topo1=None, topo2=None, selection='all', cutoff=5,
+                       length=1, step=None, reference='average', cache=None):
+    """Reads each trajectory once and builds the perturbation networks over windows of
+    length blocks of block frames (see windowed_dpns)"""
+    if topo:
+        topo1, topo2 = topo, topo
+    selection = selection.replace("not hydrogen", "!(name =~'H.*')")
+    aanet1, aanet2 = AANet(), AANet()
+    aanet1.create(traj1, topo=topo1, selection=selection, cutoff=cutoff, cache=cache, block=block)
+    aanet2.create(traj2, topo=topo2, selection=selection, cutoff=cutoff, cache=cache, block=block)
+    return windowed_dpns(aanet1, aanet2, length, step, reference)
+
+def create_dpn_parallel(traj_list, topo_list, selection='all', cutoff=5, output_folder=None, name_list=None, cache=None,
+                        pbc=False, neighbor='kdtree', skin=2):
     n_cpu = multiprocessing.cpu_count()
     n_trajs = len(traj_list)
     if type(topo_list) != list:
@@ -354,9 +776,14 @@ def create_dpn_parallel(traj_list, topo_list, selection='all', cutoff=5, output_
 
     selection = [selection]*n_trajs
     cutoff = [cutoff]*n_trajs
+    cache = [cache]*n_trajs
+    pbc = [pbc]*n_trajs
+    neighbor = [neighbor]*n_trajs
+    skin = [skin]*n_trajs
 
     pool = multiprocessing.Pool(processes=min(n_cpu, n_trajs))
-    networks = pool.starmap(create_aan_parallel, zip(traj_list, topo_list, selection, cutoff, output_list))
+    networks = pool.starmap(create_aan_parallel, zip(traj_list, topo_list, selection, cutoff, output_list, cache, pbc,
+                                                     neighbor, skin))
     dpn_list = []
     for i, j in combinations(range(len(networks)), 2):
         dpn = DynPertNet()
@@ -367,9 +794,9 @@ def create_dpn_parallel(traj_list, topo_list, selection='all', cutoff=5, output_
     return dpn_list
      
 
-def create_aan_parallel(traj, topo, selection, cutoff, output):
+def create_aan_parallel(traj, topo, selection, cutoff, output, cache=None, pbc=False, neighbor='kdtree', skin=2):
     aanet = AANet()
-    aanet.create(traj, topo, selection, cutoff)
+    aanet.create(traj, topo, selection, cutoff, cache=cache, pbc=pbc, neighbor=neighbor, skin=skin)
     if output != None:
         aanet.save(output)
     return aanet.net
@@ -385,11 +812,11 @@ def load_dpn(path):
     dpn.load(path)
     return dpn
 
-def create_multiselection(traj1, traj2, selectionList, topo=None, topo1=None, topo2=None, selection='all', cutoff=5, output_atomic=None, output_aanet=None, output=None):
+def create_multiselection(traj1, traj2, selectionList, topo=None, topo1=None, topo2=None, selection='all', cutoff=5, output_atomic=None, output_aanet=None, output=None, cache=None):
     if topo:
         topo1, topo2 = topo, topo
-    aanet1_list = create_aanet_multiselection(traj1, selectionList=selectionList, topo=topo1, selection=selection, cutoff=cutoff, output_atomic=output_atomic[0], output_list=output_aanet[0])
-    aanet2_list = create_aanet_multiselection(traj2, selectionList=selectionList, topo=topo2, selection=selection, cutoff=cutoff, output_atomic=output_atomic[1], output_list=output_aanet[1])
+    aanet1_list = create_aanet_multiselection(traj1, selectionList=selectionList, topo=topo1, selection=selection, cutoff=cutoff, output_atomic=output_atomic[0], output_list=output_aanet[0], cache=cache)
+    aanet2_list = create_aanet_multiselection(traj2, selectionList=selectionList, topo=topo2, selection=selection, cutoff=cutoff, output_atomic=output_atomic[1], output_list=output_aanet[1], cache=cache)
     dpn_list, i = [], 0
     for aanet1, aanet2 in zip(aanet1_list, aanet2_list):
         dpn = DynPertNet()
@@ -402,21 +829,198 @@ def create_multiselection(traj1, traj2, selectionList, topo=None, topo1=None, to
 
     return dpn_list
 
-def create_default(traj1, traj2, topo, output_folder, name1, name2):
+def create_default(traj1, traj2, topo, output_folder, name1, name2, cache=None):
     selectionList = ['all', 'not hydrogen', 'backbone || name H HA', 'backbone', 'sidechain', 'sidechain && not hydrogen', ['all', 'name H N']]
     outs = ['allH', 'all', 'backboneH', 'backbone', 'sidechainH', 'sidechain', 'amide_proton']
     mkdir(jn(output_folder, 'atomic'), exist_ok=True)
-    output_atomic = [jn(output_folder, 'atomic', '{0}.p'.format(name)) for name in [name1, name2]]
+    output_atomic = [jn(output_folder, 'atomic', '{0}.dpnc'.format(name)) for name in [name1, name2]]
     mkdir(jn(output_folder, 'aa_networks'), exist_ok=True)
     output_aanet = [[jn(output_folder, 'aa_networks', '{0}_{1}.p'.format(selection, name1)) for selection in outs],
                    [jn(output_folder, 'aa_networks', '{0}_{1}.p'.format(selection, name2)) for selection in outs]]
     output = [jn(output_folder, '{0}.p'.format(selection)) for selection in outs]
 
-    dpn_list = create_multiselection(traj1, traj2, selectionList, topo=topo, selection='all', cutoff=5, output_atomic=output_atomic, output_aanet=output_aanet, output=output)
+    dpn_list = create_multiselection(traj1, traj2, selectionList, topo=topo, selection='all', cutoff=5, output_atomic=output_atomic, output_aanet=output_aanet, output=output, cache=cache)
 
     return dpn_list
     
 
+def extraction_memory(n_atoms, chunk, buffer_size=2**23):
+    """Estimated peak memory in bytes of one atomic contact extraction: a chunk of
+    float32 coordinates and the buffered and coalesced int64 pair counts"""
+    return chunk*n_atoms*3*4 + 4*buffer_size*8
+
+def extract_atomic(traj, topo, baseSelection, cutoff, chunk, output, cache=None, pbc=False, neighbor='kdtree',
+                   skin=2):
+    """Worker of run_pipeline: computes and saves the atomic contacts of one replica
+    Returns: output: str, elapsed time: float"""
+    start = time.perf_counter()
+    aanet = AANet()
+    aanet.create_atomic(traj, baseSelection, topo=topo, cutoff=cutoff, chunk=chunk, cache=cache,
+                        checkpoint=output+'.ckpt', resume=True, pbc=pbc,
+                        neighbor=neighbor, skin=skin)
+    aanet.save_atomic(output)
+    return output, time.perf_counter() - start
+
+def run_pipeline(traj_map, topo_map, selectionList, output_folder, names=None, baseSelection='all', cutoff=5,
+                 n_procs=None, max_memory=None, chunk=10000, cache=None, per_replica=True, overwrite=False,
+                 resample=None, pbc=False, neighbor='kdtree', skin=2):
+    """Builds the networks of every selection for every state and all the pairwise
+    perturbation networks between states. Trajectories are read once: the atomic
+    contacts of each (state, replica) are extracted in a pool of processes, and the
+    amino acid networks of all selections are derived from them with create_list.
+    Outputs are written in output_folder:
+        atomic/{state}_R{replica}.dpnc: atomic contacts of each replica
+        aa_networks/{name}/{state}.p and {state}_R{replica}.p: amino acid networks
+        {name}/{state1}v{state2}.p: perturbation networks between states (all replicas)
+        {name}/R{replica}/{state1}v{state2}.p: perturbation networks between replicas
+        timing.json: time spent in each stage
+    Parameters: traj_map: dict state -> list of str: trajectories of each replica (a 
+    replica can also be a list of trajectories)
+    topo_map: dict state -> str or str: topology of each state
+    selectionList: list of str or tuple of str: selections of the networks (see create_list)
+    names: list of str, optional: names of the selections in the outputs
+    baseSelection: str: atoms of the atomic networks, should include all the selections
+    cutoff: number: contact cutoff in Angstrom
+    n_procs: int, optional: maximal number of workers, default: number of cpus
+    max_memory: int, optional: memory budget in bytes of the workers, bounding their number
+    chunk: int: number of frames loaded at once by each worker
+    cache: ContactCache or str, optional: cache of the per trajectory counts
+    per_replica: bool: if True, perturbation networks are also built replica by replica
+    overwrite: bool: if False, atomic contacts already in output_folder are reused
+    resample: str, optional: 'bootstrap' or 'jackknife', resampling statistics of the
+    perturbation networks between states over their replicas (see DynPertNet.resample)
+    pbc: bool: if True, contacts are computed with periodic boundary conditions
+    neighbor, skin: neighbor search, 'kdtree' or 'verlet' with its skin in Angstrom (see AANet.create)
+    Returns: dpns: dict (name, state1, state2) or (name, state1, state2, replica) -> DynPertNet,
+    timing: dict stage -> seconds"""
+    names = names if names else ['sel{0}'.format(i) for i in range(len(selectionList))]
+    topo_map = topo_map if isinstance(topo_map, dict) else {state: topo_map for state in traj_map}
+    states, timing = list(traj_map), {}
+    baseSelection = baseSelection.replace("not hydrogen", "!(name =~'H.*')")
+    for folder in ['atomic'] + [jn('aa_networks', name) for name in names]:
+        mkdir(jn(output_folder, folder), exist_ok=True)
+
+    #Stage 1: atomic contacts of every (state, replica)
+    start = time.perf_counter()
+    atomic, tasks = {}, []
+    for state in states:
+        for replica, traj in enumerate(traj_map[state], 1):
+            output = jn(output_folder, 'atomic', '{0}_R{1}.dpnc'.format(state, replica))
+            atomic[state, replica] = output
+            if overwrite or not os.path.exists(output):
+                tasks.append((traj, topo_map[state], baseSelection, cutoff, chunk, output, cache, pbc, neighbor,
+                              skin))
+    n_workers = min(n_procs or multiprocessing.cpu_count(), max(len(tasks), 1))
+    if max_memory:
+        #Without a topology, the first trajectory of the state holds it
+        first = {state: traj_map[state][0] if type(traj_map[state][0]) == str else traj_map[state][0][0]
+                 for state in states}
+        n_atoms = max(load_topology(first[state], topo_map[state]).select(baseSelection).size for state in states)
+        n_workers = max(1, min(n_workers, int(max_memory // extraction_memory(n_atoms, chunk))))
+    print('Extracting {0} atomic networks with {1} workers'.format(len(tasks), n_workers))
+    #Workers are renewed after each task so that their memory is released
+    with multiprocessing.Pool(processes=n_workers, maxtasksperchild=1) as pool:
+        for output, elapsed in pool.starmap(extract_atomic, tasks):
+            print('{0}: {1:.1f} s'.format(output, elapsed))
+    timing['extraction'] = time.perf_counter() - start
+
+    #Stage 2: amino acid networks of every selection
+    start = time.perf_counter()
+    networks = {}
+    for state in states:
+        replicas = []
+        for replica in range(1, len(traj_map[state])+1):
+            aanet = AANet()
+            aanet.load_atomic(atomic[state, replica], topo=topo_map[state])
+            replicas.append(aanet)
+            if per_replica or resample:
+                for name, net in zip(names, aanet.create_list(selectionList)):
+                    networks[name, state, replica] = net
+        for name, net in zip(names, merge_aanets(replicas).create_list(selectionList)):
+            networks[name, state, None] = net
+    for (name, state, replica), net in networks.items():
+        suffix = '' if replica is None else '_R{0}'.format(replica)
+        nx.write_gpickle(net, jn(output_folder, 'aa_networks', name, '{0}{1}.p'.format(state, suffix)))
+    timing['networks'] = time.perf_counter() - start
+
+    #Stage 3: pairwise perturbation networks
+    start = time.perf_counter()
+    dpns = {}
+    n_replicas = min(len(traj_map[state]) for state in states) if per_replica else 0
+    for name in names:
+        for replica in [None] + list(range(1, n_replicas+1)):
+            folder = jn(output_folder, name) if replica is None else jn(output_folder, name, 'R{0}'.format(replica))
+            mkdir(folder, exist_ok=True)
+            for state1, state2 in combinations(states, 2):
+                dpn = DynPertNet()
+                dpn.create(networks[name, state1, replica], networks[name, state2, replica])
+                if resample and replica is None:
+                    dpn.resample([networks[name, state1, r] for r in range(1, len(traj_map[state1])+1)],
+                                 [networks[name, state2, r] for r in range(1, len(traj_map[state2])+1)], resample)
+                dpn.save(jn(folder, '{0}v{1}.p'.format(state1, state2)))
+                dpns[(name, state1, state2) if replica is None else (name, state1, state2, replica)] = dpn
+    timing['dpn'] = time.perf_counter() - start
+
+    timing['total'] = sum(timing.values())
+    for stage, elapsed in timing.items():
+        print('{0}: {1:.1f} s'.format(stage, elapsed))
+    with open(jn(output_folder, 'timing.json'), 'w') as f:
+        json.dump(timing, f, indent=1)
+    return dpns, timing
+
+#Default methods of network_thresholds and batch_thresholds
+THRESHOLD_METHODS = ['tail', 'cluster', 'component']
+
+def network_thresholds(net, methods=None, options=None):
+    """Computes the optimal thresholds of one network for several methods. The 
+    sorted weights of the network are computed once and shared by the tail, 
+    the sweep engine of cluster, component and the edge counts.
+    Parameters: net: DynPertNet or str: network or path of a saved network
+    methods: list of str, optional: methods of get_optimal_threshold, default: 
+    tail, cluster and component
+    options: dict, optional: keyword arguments of each method, e.g. {'tail': {'tail': 0.05}}
+    Returns: list of (method, threshold, number of edges kept)"""
+    dpn = net if isinstance(net, DynPertNet) else load_dpn(net)
+    methods = methods if methods else THRESHOLD_METHODS
+    options = options or {}
+    rows = []
+    for method in methods:
+        threshold = dpn.get_optimal_threshold(method, **options.get(method, {}))
+        n_edges = dpn.edges.n_edges if threshold is None else dpn.edges.threshold(threshold).n_edges
+        rows.append((method, threshold, n_edges))
+    return rows
+
+def batch_thresholds(networks, methods=None, options=None, n_procs=None):
+    """Computes the optimal thresholds of many networks for several methods, one 
+    network per process, so that the run takes about as long as the slowest network.
+    Parameters: networks: list or dict of DynPertNet or paths of saved networks 
+    (dict keys name the networks, otherwise paths or positions are used)
+    methods: list of str, optional: methods of get_optimal_threshold, default: 
+    tail, cluster and component
+    options: dict, optional: keyword arguments of each method, e.g. {'tail': {'tail': 0.05}}
+    n_procs: int, optional: number of processes, default: number of cpus
+    Returns: pandas DataFrame with columns network, method, threshold, n_edges"""
+    import pandas as pd
+    methods = methods if methods else THRESHOLD_METHODS
+    if isinstance(networks, dict):
+        names, networks = list(networks.keys()), list(networks.values())
+    else:
+        names = [net if type(net) == str else i for i, net in enumerate(networks)]
+    #Only the edge arrays of loaded networks are sent to the workers
+    jobs = []
+    for net in networks:
+        if isinstance(net, DynPertNet):
+            _net = DynPertNet()
+            _net.edges = net.edges
+            net = _net
+        jobs.append((net, methods, options))
+    n_procs = min(n_procs or multiprocessing.cpu_count(), max(len(jobs), 1))
+    with multiprocessing.Pool(processes=n_procs) as pool:
+        results = pool.starmap(network_thresholds, jobs)
+    rows = [(name, method, threshold, n_edges) for name, result in zip(names, results)
+            for method, threshold, n_edges in result]
+    return pd.DataFrame(rows, columns=['network', 'method', 'threshold', 'n_edges'])
+
 
 
 if __name__ == '__main__':
@@ -1,6 +1,4 @@
-import numpy as np
-from dynpertnet import t2o, three2one
-from Bio.PDB import PDBParser
+from residue_coords import ResidueCoords
 import pickle as pkl 
 
 # L_OXY = [44, 16, 57.5, 50.6, 75.5, 75.7, 32.26, 61.28, 14.43]
@@ -21,24 +19,11 @@ L_OXY = [-11.098, -12.387, 67.007004,
 def get_pos_OXY(pdb_path, O, X, Y, output, chaintop=None):
     """ Draws the network using the O X Y method, O, X, Y are 3d coordinate points that should 
     frame the representation"""
-    Ox = [c1-c2 for c1, c2 in zip(O, X)]   
-    Oy = [c1-c2 for c1, c2 in zip(O, Y)]
-    normOx = np.linalg.norm(Ox)  
-    normOy = np.linalg.norm(Oy)
-    structure = PDBParser().get_structure('X', pdb_path)[0]
-    pos = {}
-    distance_thresh = 1
-    for atom in structure.get_atoms():
-        if atom.id == 'CA':
-            residue = atom.parent
-            if chaintop:
-                c = 1*(residue.parent.id == chaintop)
-            else:
-                c = 0
-            AO = [c1-c2 for c1, c2 in zip(O, atom.coord)]
-            x = np.linalg.norm(np.cross(AO,Ox))/normOx
-            y = np.linalg.norm(np.cross(AO,Oy))/normOy+1*c
-            pos[t2o(residue.resname)+str(residue.id[1])+':'+residue.parent.id] = (x, y)
+    index = ResidueCoords.from_pdb(pdb_path)
+    xy = index.project_OXY(O, X, Y)
+    if chaintop:
+        xy[:, 1] += 1*(index.chains == chaintop)
+    pos = index.positions(xy)
     pkl.dump(pos, open(output, 'wb'))
 
 if __name__ == '__main__':
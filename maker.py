@@ -4,17 +4,452 @@ import numpy as np
 from scipy.spatial import cKDTree
 import mdtraj as md
 import pickle as pkl
+import os
 import multiprocessing
 from os.path import join as jn
-from Bio.PDB.Polypeptide import aa1, aa3
-from Bio.PDB.PDBExceptions import PDBConstructionWarning
-import warnings
-warnings.simplefilter('ignore', PDBConstructionWarning)
+#One and three letter codes of the amino acids (as Bio.PDB.Polypeptide aa1, aa3)
+aa1 = 'ACDEFGHIKLMNPQRSTVWY'
+aa3 = ['ALA', 'CYS', 'ASP', 'GLU', 'PHE', 'GLY', 'HIS', 'ILE', 'LYS', 'LEU', 
+       'MET', 'ASN', 'PRO', 'GLN', 'ARG', 'SER', 'THR', 'VAL', 'TRP', 'TYR']
 three2one = dict(zip(aa3, aa1))
 t2o = lambda X: three2one[X] if X in three2one else X[0]
 label =  lambda X: t2o(X.name)+str(X.index)
 from tqdm import tqdm
 from scipy.sparse import csr_matrix
+from contactfile import write_contacts, read_contacts, is_contact_file
+from cache import get_cache
+from contactseries import ContactSeries
+
+def atom2residue(topology):
+    """Returns an int32 array giving the residue index of each atom of the topology"""
+    return np.fromiter((atom.residue.index for atom in topology.atoms), 
+                       dtype=np.int32, count=topology.n_atoms)
+
+class ResidueCounter():
+    """Accumulates residue contact counts from arrays of atomic pairs.
+    Atomic pairs (as returned by cKDTree.query_pairs(output_type='ndarray')) are
+    mapped to residue pairs through an atom to residue lookup array and counted 
+    with np.bincount on the linearized pair index. Indices are buffered over 
+    several frames so that the bincount over n_residues**2 bins is only paid once 
+    per buffer.
+    Parameters: atom2res: np.array of int: residue index of each atom
+    n_residues: int: number of residues
+    buffer_size: int: number of residue pairs to buffer before counting
+    """
+    def __init__(self, atom2res, n_residues, buffer_size=2**22):
+        self.atom2res = atom2res
+        self.n_residues = n_residues
+        self.buffer_size = buffer_size
+        self._counts = np.zeros(n_residues*n_residues, dtype=np.int64)
+        self._buffer, self._buffered = [], 0
+
+    def add(self, pairs):
+        """Adds the contacts of one frame
+        Parameters: pairs: np.array of shape (n_pairs, 2): contacting atom indices"""
+        res = self.atom2res[pairs]
+        #R[i, j] for atom pair (a, b) with a<b, same layout as T^t.A.T
+        self._buffer.append(res[:,0].astype(np.int64)*self.n_residues + res[:,1])
+        self._buffered += len(res)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Counts the buffered residue pairs"""
+        if self._buffer:
+            self._counts += np.bincount(np.concatenate(self._buffer), 
+                                        minlength=self._counts.size)
+            self._buffer, self._buffered = [], 0
+
+    @property
+    def counts(self):
+        """Residue contact counts as a (n_residues, n_residues) array"""
+        self.flush()
+        return self._counts.reshape(self.n_residues, self.n_residues)
+
+    def reset(self):
+        """Sets the counts back to zero"""
+        self._counts[:] = 0
+        self._buffer, self._buffered = [], 0
+
+class AtomicCounter():
+    """Accumulates atomic contact counts from arrays of atomic pairs in a sparse way.
+    Pairs are buffered as linearized indices and periodically coalesced into sorted
+    (index, count) arrays, so that memory is proportional to the number of distinct
+    contacting pairs.
+    Parameters: n_atoms: int: number of atoms
+    buffer_size: int: number of atomic pairs to buffer before coalescing
+    """
+    def __init__(self, n_atoms, buffer_size=2**23):
+        self.n_atoms = n_atoms
+        self.buffer_size = buffer_size
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0, dtype=np.int64)
+        self._buffer, self._buffered = [], 0
+
+    def add(self, pairs):
+        """Adds the contacts of one frame
+        Parameters: pairs: np.array of shape (n_pairs, 2): contacting atom indices"""
+        self._buffer.append(pairs[:,0].astype(np.int64)*self.n_atoms + pairs[:,1])
+        self._buffered += len(pairs)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Coalesces the buffered pairs into the sorted counts"""
+        if self._buffer:
+            keys, values = np.unique(np.concatenate(self._buffer), return_counts=True)
+            self.keys, self.values = coalesce(np.concatenate([self.keys, keys]), 
+                                              np.concatenate([self.values, values]))
+            self._buffer, self._buffered = [], 0
+
+    @property
+    def counts(self):
+        """Atomic contact counts as a (n_atoms, n_atoms) csr_matrix"""
+        self.flush()
+        return csr_matrix((self.values, (self.keys // self.n_atoms, self.keys % self.n_atoms)),
+                          shape=(self.n_atoms, self.n_atoms))
+
+class SeriesRecorder():
+    """Records the residue contacts of each frame in a ContactSeries store
+    Parameters: series: ContactSeries opened for appending
+    atom2res: np.array of int: residue index of each atom
+    """
+    def __init__(self, series, atom2res):
+        self.series = series
+        self.atom2res = atom2res
+
+    def add(self, pairs):
+        """Appends the contacts of one frame, with the same layout as ResidueCounter"""
+        res = self.atom2res[pairs]
+        self.series.add(res[:,0].astype(np.int64)*self.series.n_residues + res[:,1])
+
+    def end_segment(self, name, n_frames):
+        """Records the end of the trajectory name of n_frames frames"""
+        self.series.add_segment(name, n_frames)
+
+class BlockRecorder():
+    """Sums the residue contacts over consecutive blocks of frames, so that block and
+    sliding window averages are known after a single pass over the trajectories.
+    Blocks do not span two trajectories: the last block of a trajectory can be shorter.
+    Parameters: atom2res: np.array of int: residue index of each atom
+    n_residues: int: number of residues
+    block: int: number of frames per block
+    """
+    def __init__(self, atom2res, n_residues, block):
+        self.block = block
+        self.counts, self.frames, self.segments = [], [], []
+        self._counter, self._n, self._segment = ResidueCounter(atom2res, n_residues), 0, 0
+
+    def add(self, pairs):
+        """Adds the contacts of one frame"""
+        self._counter.add(pairs)
+        self._n += 1
+        if self._n == self.block:
+            self.flush()
+
+    def flush(self):
+        """Closes the current block"""
+        if self._n:
+            self.counts.append(csr_matrix(self._counter.counts))
+            self.frames.append(self._n)
+            self.segments.append(self._segment)
+            self._counter.reset()
+            self._n = 0
+
+    def end_segment(self, name, n_frames):
+        """Closes the last block of a trajectory"""
+        self.flush()
+        self._segment += 1
+
+    def windows(self, length=1, step=None):
+        """Returns the average contacts over windows of length blocks every step blocks
+        (default: non overlapping windows), windows not spanning two trajectories
+        Returns: list of (first frame, number of frames, csr_matrix average)"""
+        step = step if step else length
+        frames, segments = np.array(self.frames), np.array(self.segments)
+        first = np.concatenate([[0], np.cumsum(frames)[:-1]])
+        windows = []
+        for segment in np.unique(segments):
+            blocks = np.flatnonzero(segments == segment)
+            for k in range(0, len(blocks) - length + 1, step):
+                window = blocks[k:k+length]
+                n_frames = int(frames[window].sum())
+                average = sum(self.counts[i] for i in window[1:]) + self.counts[window[0]]
+                windows.append((int(first[window[0]]), n_frames, average/n_frames))
+        return windows
+
+def residue_weights(topology):
+    """Returns the (n_residues, n_atoms) csr_matrix giving the position of each residue
+    as a combination of atomic positions: its CA atom, or the centroid of its atoms
+    if it has no CA atom"""
+    rows, cols, weights = [], [], []
+    for residue in topology.residues:
+        atoms = [atom.index for atom in residue.atoms if atom.name == 'CA']
+        atoms = atoms if atoms else [atom.index for atom in residue.atoms]
+        rows += [residue.index]*len(atoms)
+        cols += atoms
+        weights += [1/len(atoms)]*len(atoms)
+    return csr_matrix((weights, (rows, cols)), shape=(topology.n_residues, topology.n_atoms))
+
+class CoordinateAccumulator():
+    """Accumulates the positions of the residues over the streamed frames, so that
+    their mean position is known without reading the trajectory again.
+    Parameters: weights: csr_matrix: residue positions from atomic positions (see
+    residue_weights)
+    """
+    def __init__(self, weights):
+        self.weights = weights
+        self.sum = np.zeros((weights.shape[0], 3))
+        self.n_frames = 0
+
+    def add(self, xyz):
+        """Adds frames of shape (n_frames, n_atoms, 3) in nm"""
+        #Summing the frames first so that the matrix product is paid once per chunk
+        self.sum += self.weights.dot(xyz.sum(axis=0, dtype=np.float64))*10
+        self.n_frames += len(xyz)
+
+    @property
+    def mean(self):
+        """Mean position of the residues in Angstrom"""
+        return (self.sum/max(self.n_frames, 1)).astype(np.float32)
+
+def coalesce(keys, values):
+    """Sums the values of identical keys
+    Returns: keys: sorted unique keys, values: summed values"""
+    if len(keys) == 0:
+        return keys, values
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(values, starts)
+
+def load_topology(traj, topo=None):
+    """Returns the topology of a trajectory without loading its coordinates
+    Parameters: traj: str: path of the trajectory
+    topo: str: path of the topology to use"""
+    if topo:
+        return md.load_topology(topo)
+    return md.load_frame(traj, 0).topology
+
+def count_frames(traj):
+    """Returns the number of frames of a trajectory file without loading it"""
+    with md.open(traj) as f:
+        return len(f)
+
+#Trajectory formats for which md.iterload ignores skip
+NO_SKIP_FORMATS = ('.pdb', '.pdb.gz', '.gsd')
+
+def iterchunks(traj, topo=None, atom_indices=None, start=0, stop=None, chunk=1000):
+    """Streams the frames [start, stop) of a trajectory restricted to atom_indices,
+    so that at most chunk frames of the selected atoms are in memory.
+    Yields: mdtraj.Trajectory chunks"""
+    n_frames = None if stop is None else stop - start
+    #mdtraj loads these formats whole and ignores skip, the frames are dropped here
+    skip = start if traj.endswith(NO_SKIP_FORMATS) else 0
+    for tr in md.iterload(traj, top=topo, chunk=chunk, skip=start-skip, atom_indices=atom_indices):
+        if skip:
+            dropped = min(skip, tr.n_frames)
+            tr, skip = tr[dropped:], skip - dropped
+            if tr.n_frames == 0:
+                continue
+        if n_frames is not None:
+            tr = tr[:n_frames]
+            n_frames -= tr.n_frames
+        yield tr
+        if n_frames is not None and n_frames <= 0:
+            break
+
+#Image shifts of the 26 neighboring cells in fractional coordinates
+SHIFTS = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1) 
+                   if (i, j, k) != (0, 0, 0)])
+
+def periodic_pairs(xyz, r, box):
+    """Returns the pairs of atoms closer than r under periodic boundary conditions
+    (minimum image, r should be below half the smallest box height)
+    Parameters: xyz: np.array of shape (n_atoms, 3): coordinates
+    box: np.array of shape (3, 3): box vectors (rows), as mdtraj unitcell_vectors
+    Returns: np.array of shape (n_pairs, 2) of atom indices (i < j)"""
+    if np.allclose(box - np.diag(np.diag(box)), 0):
+        #Orthorhombic box: periodic KDTree on the coordinates wrapped in the box
+        lengths = np.diag(box).astype(np.float64)
+        wrapped = np.mod(xyz, lengths)
+        wrapped[wrapped >= lengths] = 0
+        return cKDTree(wrapped, boxsize=lengths).query_pairs(r=r, output_type='ndarray')
+    #Triclinic box: wrapping in fractional coordinates, then adding the images of the
+    #atoms closer than r to a face of the cell
+    frac = xyz.astype(np.float64) @ np.linalg.inv(box)
+    frac -= np.floor(frac)
+    volume = abs(np.linalg.det(box))
+    heights = volume/np.linalg.norm(np.cross(box[[1, 2, 0]], box[[2, 0, 1]]), axis=1)
+    low, high = frac < r/heights, frac > 1 - r/heights
+    images, owners = [frac @ box], [np.arange(len(xyz))]
+    for shift in SHIFTS:
+        #Shifting by +1 along an axis brings the atoms of the low side next to the high side
+        near = np.all(np.where(shift > 0, low, True) & np.where(shift < 0, high, True), axis=1)
+        if near.any():
+            images.append((frac[near] + shift) @ box)
+            owners.append(np.flatnonzero(near))
+    owners = np.concatenate(owners)
+    pairs = cKDTree(np.concatenate(images)).query_pairs(r=r, output_type='ndarray')
+    #Keeping the pairs with at least one atom in the cell, once
+    pairs = owners[pairs[pairs[:, 0] < len(xyz)]]
+    pairs = np.sort(pairs[pairs[:, 0] != pairs[:, 1]], axis=1)
+    keys = np.unique(pairs[:, 0].astype(np.int64)*len(xyz) + pairs[:, 1])
+    return np.stack([keys // len(xyz), keys % len(xyz)], axis=1)
+
+def frame_pairs(xyz, r, box=None):
+    """Returns the pairs of atoms of a frame closer than r, with periodic boundary 
+    conditions if box is given"""
+    if box is None:
+        #Here we're using the cPython KDTree algorithm to get the neighbors
+        return cKDTree(xyz).query_pairs(r=r, output_type='ndarray')
+    return periodic_pairs(xyz, r, box)
+
+class KDTreeSearch():
+    """Neighbor search building a KDTree for every frame
+    Parameters: r: number: cutoff in nm"""
+    def __init__(self, r):
+        self.r = r
+
+    def pairs(self, xyz, box=None):
+        return frame_pairs(xyz, self.r, box)
+
+class VerletList():
+    """Neighbor search reusing a Verlet list across frames: the pairs closer than
+    r + skin are searched once, with the periodic image of each pair, and the pairs
+    closer than r are filtered from them with a vectorized distance check until an 
+    atom moved by more than skin/2 (or the box deformed as much) since the list was
+    built, when it is rebuilt.
+    Parameters: r: number: cutoff in nm
+    skin: number: skin distance in nm
+    """
+    def __init__(self, r, skin=0.2):
+        self.r, self.skin = r, skin
+        self.reference, self.box, self.n_builds, self.n_frames = None, None, 0, 0
+
+    def build(self, xyz, box):
+        self.reference, self.box = xyz.copy(), box
+        self.candidates = frame_pairs(xyz, self.r + self.skin, box)
+        self.i, self.j = self.candidates[:,0].copy(), self.candidates[:,1].copy()
+        self.images = np.zeros((len(self.candidates), 3))
+        if box is not None:
+            #Integer image of each pair, the one of minimum distance at build time
+            inverse = np.linalg.inv(box)
+            columns = np.ascontiguousarray(xyz.T, dtype=np.float64)
+            d = np.stack([column[self.i] - column[self.j] for column in columns], axis=1)
+            images = np.round(d @ inverse)
+            #Rounding in a triclinic box can miss the image by one cell. As r + skin is
+            #below half the box heights, a single image is closer than r + skin.
+            far = np.flatnonzero(np.linalg.norm(d - images @ box, axis=1) > self.r + self.skin)
+            base = images[far]
+            for shift in SHIFTS:
+                found = np.linalg.norm(d[far] - (base + shift) @ box, axis=1) <= self.r + self.skin
+                images[far[found]] = base[found] + shift
+            self.images = images
+        self.shifts = None if box is None else self.translations(box)
+        self.n_builds += 1
+
+    def translations(self, box):
+        """Returns the (3, n_candidates) translations of the pairs to their images"""
+        return np.ascontiguousarray((self.images @ box.astype(np.float64)).T)
+
+    def outdated(self, xyz, box):
+        """Returns True if the list can miss pairs of the frame"""
+        if self.reference is None or (box is None) != (self.box is None):
+            return True
+        moved = 2*np.sqrt(np.max(np.sum((xyz - self.reference)**2, axis=1)))
+        if box is not None and not np.array_equal(box, self.box):
+            #Pairs of other images also move when the box deforms
+            moved += np.max(np.linalg.norm(self.images @ (box - self.box), axis=1), initial=0)
+        return moved > self.skin
+
+    def pairs(self, xyz, box=None):
+        """Returns the pairs of atoms of a frame closer than r"""
+        self.n_frames += 1
+        frame = xyz
+        if box is not None and self.box is not None and self.reference is not None:
+            #Atoms wrapped back into the box since the build are moved next to their
+            #reference position, by whole box vectors so that pair distances are kept
+            jumps = np.round((xyz - self.reference) @ np.linalg.inv(box))
+            if jumps.any():
+                xyz = xyz - jumps @ box
+        if self.outdated(xyz, box):
+            self.build(xyz, box)
+        #Gathering axis by axis from contiguous columns is much faster than xyz[i].
+        #Distances are compared in float64 and with <=, as in cKDTree.query_pairs.
+        d2 = np.zeros(len(self.candidates))
+        if box is not None and np.allclose(box - np.diag(np.diag(box)), 0):
+            #Orthorhombic box: minimum image of the coordinates wrapped as in
+            #periodic_pairs, so that distances are rounded as in the periodic KDTree
+            lengths = np.diag(box).astype(np.float64)
+            wrapped = np.mod(frame, lengths)
+            wrapped[wrapped >= lengths] = 0
+            for column, length in zip(np.ascontiguousarray(wrapped.T), lengths):
+                d = column[self.i] - column[self.j]
+                d -= length*np.round(d/length)
+                d2 += d*d
+            return self.candidates[d2 <= self.r**2]
+        shifts = self.shifts
+        if box is not None and not np.array_equal(box, self.box):
+            shifts = self.translations(box)
+        for axis, column in enumerate(np.ascontiguousarray(xyz.T, dtype=np.float64)):
+            d = column[self.i] - column[self.j]
+            if shifts is not None:
+                d -= shifts[axis]
+            d2 += d*d
+        return self.candidates[d2 <= self.r**2]
+
+NEIGHBORS = {'kdtree': KDTreeSearch, 'verlet': VerletList}
+
+def neighbor_search(neighbor, cutoff, skin=2):
+    """Returns a neighbor search engine
+    Parameters: neighbor: str: 'kdtree' (a KDTree per frame) or 'verlet' (Verlet list)
+    cutoff, skin: number: cutoff and skin of the Verlet list in Angstrom"""
+    if neighbor == 'kdtree':
+        return KDTreeSearch(cutoff/10.)
+    elif neighbor == 'verlet':
+        return VerletList(cutoff/10., skin/10.)
+    raise ValueError("neighbor should be one of {0}, not {1}".format(list(NEIGHBORS), neighbor))
+
+def count_contacts(counter, coords, cutoff, recorders=(), boxes=None, search=None):
+    """Adds the contacts of each frame of coords (in nm) to counter, and to the 
+    per-frame recorders if given
+    Parameters: boxes: np.array of shape (n_frames, 3, 3), optional: box vectors of
+    each frame (nm) for periodic boundary conditions
+    search: KDTreeSearch or VerletList, optional: neighbor search engine, kept 
+    between calls on consecutive frames, default: a KDTree per frame"""
+    #Cutoff is in Angstrom but mdtraj uses nm
+    search = search if search else KDTreeSearch(cutoff/10.)
+    for frame, xyz in enumerate(coords):
+        pairs = search.pairs(xyz, None if boxes is None else boxes[frame])
+        counter.add(pairs)
+        for recorder in recorders:
+            recorder.add(pairs)
+
+def unitcells(tr, pbc):
+    """Returns the box vectors of the frames of a chunk if pbc, None otherwise"""
+    if not pbc:
+        return None
+    if tr.unitcell_vectors is None:
+        raise ValueError('Periodic boundary conditions need a trajectory with unit cells')
+    return tr.unitcell_vectors
+
+def count_frame_range(traj, topo, atom_indices, atom2res, n_residues, cutoff, start, stop, chunk=1000,
+                      weights=None, pbc=False, neighbor='kdtree', skin=2):
+    """Counts the residue contacts of the frames [start, stop) of a trajectory.
+    Parameters: weights: csr_matrix, optional: if given, residue positions are summed too
+    pbc: bool: if True, contacts are computed with periodic boundary conditions
+    neighbor, skin: neighbor search engine (see neighbor_search)
+    Returns: np.array of shape (n_residues, n_residues): residue contact counts,
+    np.array of shape (n_residues, 3) or None: sum of the residue positions"""
+    counter = ResidueCounter(atom2res, n_residues)
+    positions = CoordinateAccumulator(weights) if weights is not None else None
+    search = neighbor_search(neighbor, cutoff, skin)
+    for tr in iterchunks(traj, topo, atom_indices, start, stop, chunk):
+        count_contacts(counter, tr.xyz, cutoff, boxes=unitcells(tr, pbc), search=search)
+        if positions:
+            positions.add(tr.xyz)
+    return counter.counts, positions.sum if positions else None
 
 class AANet():
     """Class to create an AANetwork from a trajectory"""
@@ -24,90 +459,200 @@ class AANet():
     def load(self, input):
         nx.read_gpickle(input)
 
-    def create(self, traj, topo=None, selection='all', cutoff=5):
-        #Loading trajectory
-        t = md.load(traj, top=topo)
-        #Slicing atoms of interest
+    def select_atoms(self, traj, topo=None, selection='all'):
+        """Selects the atoms of interest once on the topology and sets the residue
+        labels of the network.
+        Returns: atom_indices: np.array or None (all atoms), atom2res: np.array: 
+        residue index of each selected atom"""
+        topology = load_topology(traj, topo)
+        atom_indices = None
         if selection != 'all':
-            t = t.atom_slice(t.topology.select(selection))
-        
-        #Creating our topological matrix
-        n_atoms, n_residues = t.topology.n_atoms, t.topology.n_residues
-        labels = list(map(label, t.topology.residues))
-        self.id2label = dict(zip(list(range(n_residues)), labels))
+            atom_indices = topology.select(selection)
+            topology = topology.subset(atom_indices)
+        self.topology = topology
+        self.topology_path = topo if topo else traj
+        self.selection, self.atom_indices = selection, atom_indices
+        self.n_atoms, self.n_residues = topology.n_atoms, topology.n_residues
+        labels = list(map(label, topology.residues))
+        self.id2label = dict(zip(list(range(self.n_residues)), labels))
+        self.coord_sum, self.coord_frames = np.zeros((self.n_residues, 3)), 0
+        #Residue contact counts and number of frames of each trajectory (samples of
+        #the resampling statistics), and the trajectory of each
+        self.replicas, self.replica_trajs = [], []
+        return atom_indices, atom2residue(topology)
 
-        top_mat = np.zeros((n_atoms, n_residues))        
-        for atom in t.topology.atoms:
-            top_mat[atom.index, atom.residue.index] = 1
-        top_mat = csr_matrix(top_mat)
+    def traj_counts(self, traj, topo, atom_indices, counter, cutoff, chunk=1000, cache=None, start=0, stop=None,
+                    done=0, on_chunk=None, positions=None, recorders=()):
+        """Counts the contacts of the frames [start, stop) of one trajectory, or reads
+        them from the cache if they were already computed with the same inputs.
+        Parameters: counter: ResidueCounter or AtomicCounter: counter to fill
+        cache: ContactCache or None
+        done: int: number of frames of the range already in counter (resumed run)
+        on_chunk: function(counter, n_frames), optional: called after each chunk
+        positions: CoordinateAccumulator, optional: accumulator of the residue positions
+        recorders: list of SeriesRecorder or BlockRecorder, optional: per-frame 
+        recorders of the contacts. Frames are then always read, the cache being only filled.
+        Returns: counts: csr_matrix, n_frames: int"""
+        kind = 'atomic' if isinstance(counter, AtomicCounter) else 'residue'
+        if cache:
+            key = cache.key(traj, topo, self.selection, cutoff, kind, start, stop, **self.search_params())
+            #A resumed run already holds partial counts and positions of the range
+            hit = None if recorders or done else cache.get(key)
+            #Entries written without positions are recomputed when positions are needed
+            if hit and (positions is None or 'coord_sum' in hit[2]):
+                if positions:
+                    positions.sum += hit[2]['coord_sum']
+                    positions.n_frames += hit[1]['n_frames']
+                return hit[0], hit[1]['n_frames']
+        n_frames = done
+        #One search per trajectory, so that a Verlet list follows consecutive frames
+        search = neighbor_search(getattr(self, 'neighbor', 'kdtree'), cutoff, getattr(self, 'skin', 2))
+        for tr in iterchunks(traj, topo, atom_indices, start+done, stop, chunk):
+            count_contacts(counter, tqdm(tr.xyz), cutoff, recorders, unitcells(tr, getattr(self, 'pbc', False)), search)
+            if positions:
+                positions.add(tr.xyz)
+            n_frames += tr.n_frames
+            if on_chunk:
+                on_chunk(counter, n_frames)
+        counts = csr_matrix(counter.counts)
+        for recorder in recorders:
+            recorder.end_segment(traj, n_frames)
+        if cache:
+            cache.put(key, counts, arrays={'coord_sum': positions.sum if positions else None},
+                      kind=kind, n_frames=n_frames)
+        return counts, n_frames
 
-        #Getting the atomic contacts
-        coords = t.xyz
-        self.contacts = []
-        for frame in tqdm(range(t.n_frames)):
-            #Here we're using the cPython KDTree algorithm to get the neighbors
-            tree = cKDTree(coords[frame])
-            pairs = tree.query_pairs(r=cutoff/10.) #Cutoff is in Angstrom but mdtraj uses nm
-            #Creating sparse CSR matrix
-            data = np.ones(len(pairs))
-            pairs = np.array(list(pairs))
-            atoms = csr_matrix((data, (pairs[:,0], pairs[:,1])), shape=[n_atoms, n_atoms])
-            #R=T^t.A.T where R is residue contact matrix, A si atomic contact matrix and T our topological matrix
-            self.contacts.append(csr_matrix(np.dot(top_mat.transpose(),atoms.dot(top_mat))))
-        
-        #Computing average from list of csr matrices
-        average = np.zeros((n_residues, n_residues))
-        for mat in self.contacts:
-            average[mat.nonzero()] += mat.data/t.n_frames
-        self.average = average
+    def add_positions(self, positions):
+        """Folds the positions accumulated on one trajectory into the mean residue
+        positions of the network (self.coords, in Angstrom)"""
+        self.coord_sum = self.coord_sum + positions.sum
+        self.coord_frames += positions.n_frames
+        self.coords = (self.coord_sum/max(self.coord_frames, 1)).astype(np.float32)
+
+    def positions(self):
+        """Returns a dict label -> mean position of the residue"""
+        return dict(zip([self.id2label[i] for i in range(len(self.id2label))], self.coords))
+
+    def label_net(self):
+        """Builds the labeled network from the average contacts, with the mean
+        residue positions as 'coords' node attributes"""
         self.net = nx.from_numpy_array(self.average)
-        #Labeling the network
         self.net = nx.relabel_nodes(self.net, self.id2label, copy=False)
-    
-    def create_parallel(self, traj, topo=None, selection='all', cutoff=5, n_procs=1):
-        t = md.load(traj, top=topo)
-        if selection != 'all':
-            t = t.atom_slice(t.topology.select(selection))
-        #Creating our topological matrix
-        n_atoms, n_residues = t.topology.n_atoms, t.topology.n_residues
-        labels = list(map(label, t.topology.residues))
-        self.id2label = dict(zip(list(range(n_residues)), labels))
+        if getattr(self, 'coords', None) is not None:
+            nx.set_node_attributes(self.net, self.positions(), 'coords')
 
-        top_mat = np.zeros((n_atoms, n_residues))        
-        for atom in t.topology.atoms:
-            top_mat[atom.index, atom.residue.index] = 1
-        top_mat = csr_matrix(top_mat)
+    def create(self, traj, topo=None, selection='all', cutoff=5, chunk=1000, cache=None, series=None, block=None,
+               pbc=False, neighbor='kdtree', skin=2):
+        """Creates the network by streaming the trajectories, so that memory is 
+        bounded by chunk frames of the selected atoms.
+        Parameters: traj: str or list of str: path of trajectories to load
+        topo: str: path of topology to use
+        selection: str: atoms on which to compute the network
+        cutoff: number: contact cutoff in Angstrom
+        chunk: int: number of frames loaded at once
+        cache: ContactCache or str, optional: cache of the per trajectory counts
+        series: str, optional: folder where the residue contacts of each frame are
+        stored (see ContactSeries)
+        block: int, optional: if given, contacts are also summed over blocks of block
+        frames (self.blocks, see BlockRecorder and windows)
+        pbc: bool: if True, contacts are computed with the periodic boundary conditions
+        of the unit cells of the trajectories (orthorhombic or triclinic)
+        neighbor: str: neighbor search, 'kdtree' (a KDTree per frame) or 'verlet' 
+        (Verlet list of skin skin in Angstrom, faster when frames are close)
+        """
+        trajs = [traj] if type(traj) == str else traj
+        atom_indices, atom2res = self.select_atoms(trajs[0], topo, selection)
+        self.cutoff, self.pbc, self.neighbor, self.skin = cutoff, pbc, neighbor, skin
+        cache = get_cache(cache)
+        recorder = self.open_series(series, atom2res)
+        self.blocks = BlockRecorder(atom2res, self.n_residues, block) if block else None
+        recorders = [r for r in (recorder, self.blocks) if r]
 
         #Getting the atomic contacts
-        coords = t.xyz
-        #Chunk the contacts
-        coords = np.array_split(coords, n_procs)
-
-        def create_chunk(coords):
-            contacts = 0
-            n_frames = coords.shape[0]
-            for frame in tqdm(n_frames):
-                #Here we're using the cPython KDTree algorithm to get the neighbors
-                tree = cKDTree(coords[frame])
-                pairs = tree.query_pairs(r=cutoff/10.) #Cutoff is in Angstrom but mdtraj uses nm
-                #Creating sparse CSR matrix
-                data = np.ones(len(pairs))
-                pairs = np.array(list(pairs))
-                atoms = csr_matrix((data, (pairs[:,0], pairs[:,1])), shape=[n_atoms, n_atoms])
-                #R=T^t.A.T where R is residue contact matrix, A si atomic contact matrix and T our topological matrix
-                contacts.append(csr_matrix(np.dot(top_mat.transpose(), atoms.dot(top_mat))))            
-            #Computing average from list of csr matrices
-            average = np.zeros((n_residues, n_residues))
-            for mat in self.contacts:
-                average[mat.nonzero()] += mat.data
-            return average
+        counts, self.n_frames = csr_matrix((self.n_residues, self.n_residues), dtype=np.int64), 0
+        weights = residue_weights(self.topology)
+        for _traj in trajs:
+            counter, positions = ResidueCounter(atom2res, self.n_residues), CoordinateAccumulator(weights)
+            traj_counts, n_frames = self.traj_counts(_traj, topo, atom_indices, counter, cutoff, chunk, cache,
+                                                     positions=positions, recorders=recorders)
+            counts += traj_counts
+            self.n_frames += n_frames
+            self.replicas.append((traj_counts, n_frames))
+            self.replica_trajs.append(_traj)
+            self.add_positions(positions)
+        self.close_series(recorder)
         
-        pool = multiprocessing.Pool(processes=n_procs)
-        chunk_contacts = pool.map(create_chunk, coords)
-        self.average = sum(chunk_contacts)/t.n_frames
-        self.net = nx.from_numpy_array(self.average)
-        #Labeling the network
-        self.net = nx.relabel_nodes(self.net, self.id2label, copy=False)
+        #Computing average from the residue contact counts
+        self.counts = counts.toarray()
+        self.average = self.counts/self.n_frames
+        self.label_net()
+    
+    def create_parallel(self, traj, topo=None, selection='all', cutoff=5, n_procs=1, chunk=1000, cache=None,
+                        pbc=False, neighbor='kdtree', skin=2):
+        """Creates the network by sharding the frames of the trajectories between
+        processes. Each worker streams its own frame range from the file and returns
+        its residue contact counts, which are summed here, so the result is 
+        identical to create.
+        Parameters: traj: str or list of str: path of trajectories to load
+        topo: str: path of topology to use
+        selection: str: atoms on which to compute the network
+        cutoff: number: contact cutoff in Angstrom
+        n_procs: int: number of processes
+        chunk: int: number of frames loaded at once by each worker
+        cache: ContactCache or str, optional: cache of the per trajectory counts
+        pbc: bool: if True, contacts are computed with periodic boundary conditions
+        neighbor, skin: neighbor search engine (see create)
+        """
+        trajs = [traj] if type(traj) == str else traj
+        atom_indices, atom2res = self.select_atoms(trajs[0], topo, selection)
+        self.cutoff, self.pbc, self.neighbor, self.skin = cutoff, pbc, neighbor, skin
+        n_residues = self.n_residues
+        cache = get_cache(cache)
+        weights = residue_weights(self.topology)
+
+        #Sharding each trajectory that is not cached in frame ranges
+        tasks, owners, keys, frames, done = [], [], {}, {}, {}
+        for i, _traj in enumerate(trajs):
+            if cache:
+                keys[i] = cache.key(_traj, topo, selection, cutoff, 'residue', **self.search_params())
+                hit = cache.get(keys[i])
+                if hit and 'coord_sum' in hit[2]:
+                    positions = CoordinateAccumulator(weights)
+                    positions.sum, positions.n_frames = hit[2]['coord_sum'], hit[1]['n_frames']
+                    done[i] = (hit[0], hit[1]['n_frames'], positions)
+                    continue
+            frames[i] = count_frames(_traj)
+            bounds = np.linspace(0, frames[i], n_procs+1).astype(int)
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                if stop > start:
+                    tasks.append((_traj, topo, atom_indices, atom2res, n_residues, cutoff, start, stop, chunk, weights,
+                                  pbc, neighbor, skin))
+                    owners.append(i)
+
+        with multiprocessing.Pool(processes=n_procs) as pool:
+            chunk_contacts = pool.starmap(count_frame_range, tasks)
+        for i, n_frames in frames.items():
+            results = [result for result, owner in zip(chunk_contacts, owners) if owner == i]
+            traj_counts = csr_matrix(sum(c for c, _ in results))
+            positions = CoordinateAccumulator(weights)
+            positions.sum, positions.n_frames = sum(p for _, p in results), n_frames
+            if cache:
+                cache.put(keys[i], traj_counts, arrays={'coord_sum': positions.sum}, kind='residue', n_frames=n_frames)
+            done[i] = (traj_counts, n_frames, positions)
+
+        #Replicas follow the order of trajs, whether cached or computed
+        counts = csr_matrix((n_residues, n_residues), dtype=np.int64)
+        self.n_frames = 0
+        for i, _traj in enumerate(trajs):
+            traj_counts, n_frames, positions = done[i]
+            counts += traj_counts
+            self.n_frames += n_frames
+            self.replicas.append((traj_counts, n_frames))
+            self.replica_trajs.append(_traj)
+            self.add_positions(positions)
+        self.counts = counts.toarray()
+        self.average = self.counts/self.n_frames
+        self.label_net()
 
 
     def create_atomic_old(self, traj,  baseSelection, topo=None, cutoff=5):
@@ -122,6 +667,7 @@ class AANet():
         #Slicing atoms of interest
         if baseSelection != 'all':
             self.t = self.t.atom_slice(self.t.topology.select(baseSelection))
+        self.topology = self.t.topology
 
         self.n_atoms, self.n_residues = self.t.topology.n_atoms, self.t.topology.n_residues
         labels = list(map(label, self.t.topology.residues))
@@ -143,61 +689,289 @@ class AANet():
             self.atomic_avg += mat
         self.atomic_avg /= self.t.n_frames
 
-    def create_atomic(self, trajs, baseSelection, topo=None, cutoff=5, chunk=10000):
+    def create_atomic(self, trajs, baseSelection, topo=None, cutoff=5, chunk=10000, cache=None,
+                      checkpoint=None, checkpoint_every=1, resume=False, series=None, block=None, pbc=False,
+                      neighbor='kdtree', skin=2):
         """Function creating the atomic contact network with a desired base selection in chunks
         Parameters: traj: str or list of str: path trajectories to load
         topo: str: path of topology to use
         baseSelection: str: base selection on which to compute the atomic network. To save computation time, this should be the 
         smallest selection that includes all the selections in the list.
+        cache: ContactCache or str, optional: cache of the per trajectory counts
+        checkpoint: str, optional: path of a file where the partial counts are saved
+        every checkpoint_every chunks. It is removed once the network is complete.
+        resume: bool: if True and checkpoint exists, restarts from the last saved chunk
+        series: str, optional: folder where the residue contacts of each frame are
+        stored (see ContactSeries)
+        block: int, optional: if given, residue contacts are also summed over blocks of
+        block frames (self.blocks, see BlockRecorder and windows). Blocks are not 
+        checkpointed, so they cannot be combined with resume.
+        pbc: bool: if True, contacts are computed with periodic boundary conditions
+        neighbor, skin: neighbor search engine (see create)
         """
-        firstpass, total = True, []
-        for traj in trajs:
+        trajs = [trajs] if type(trajs) == str else trajs
+        atom_indices, atom2res = self.select_atoms(trajs[0], topo, baseSelection)
+        self.cutoff, self.pbc, self.neighbor, self.skin = cutoff, pbc, neighbor, skin
+        cache = get_cache(cache)
+        counts = csr_matrix((self.n_atoms, self.n_atoms), dtype=np.int64)
+        weights = residue_weights(self.topology)
+        self.n_frames, first, partial = 0, 0, None
+        if resume and checkpoint and os.path.exists(checkpoint):
+            if block:
+                raise ValueError('Block averages cannot be resumed from checkpoint {0}'.format(checkpoint))
+            counts, self.n_frames, first, partial = self.read_checkpoint(checkpoint, trajs)
+            #Frames stored after the checkpoint are dropped
+            recorder = self.open_series(series, atom2res, self.n_frames + (partial[2] if partial else 0))
+        else:
+            recorder = self.open_series(series, atom2res)
+        self.blocks = BlockRecorder(atom2res, self.n_residues, block) if block else None
+        recorders = [r for r in (recorder, self.blocks) if r]
+        for i, traj in enumerate(trajs):
+            if i < first:
+                continue
             print('Treating traj {}'.format(traj))
-            for i, tr in enumerate(md.iterload(traj, top=topo, chunk=chunk)):
-                print('Treating chunk {}'.format(i))
-                if firstpass:
-                    self.n_atoms, self.n_residues = tr.topology.n_atoms, tr.topology.n_residues
-                    labels = list(map(label, tr.topology.residues))
-                    self.id2label = dict(zip(list(range(self.n_residues)), labels))
-                    firstpass = False
-                    self.atomic_avg = csr_matrix((self.n_atoms, self.n_atoms))
-
-                #Slicing atoms of interest
-                if baseSelection != 'all':
-                    tr = tr.atom_slice(tr.topology.select(baseSelection))
-
-                coords = tr.xyz
-                atomicContacts = []
-                for frame in tqdm(range(tr.n_frames)):
-                    #Here we're using the cPython KDTree algorithm to get the neighbors
-                    tree = cKDTree(coords[frame])
-                    pairs = tree.query_pairs(r=cutoff/10.) #Cutoff is in Angstrom but mdtraj uses nm
-                    #Creating sparse CSR matrix
-                    data = np.ones(len(pairs))
-                    pairs = np.array(list(pairs))
-                    atomicContacts.append(csr_matrix((data, (pairs[:,0], pairs[:,1])), shape=[self.n_atoms, self.n_atoms]))            
-                
-                #Computing average atomic network from list of csr matrices
-                chunk_avg = np.zeros((self.n_atoms, self.n_atoms)) 
-                for mat in atomicContacts:
-                    chunk_avg[mat.nonzero()] += mat.data
-                chunk_avg = csr_matrix(chunk_avg)
-                chunk_avg /= tr.n_frames
-                total.append((chunk_avg, tr.n_frames))
-        self.n_frames = np.sum([elt[1] for elt in total])
-        for mat, fact in total:
-            self.atomic_avg[mat.nonzero()] += mat.data*(fact/self.n_frames)
+            #Sparse counts: memory is proportional to the number of contacting pairs
+            counter, positions, done, on_chunk = AtomicCounter(self.n_atoms), CoordinateAccumulator(weights), 0, None
+            if i == first and partial:
+                counter.keys, counter.values, done, positions.sum = partial
+                positions.n_frames = done
+            if checkpoint:
+                def on_chunk(counter, n_frames, i=i, n_chunks=[0], positions=positions):
+                    n_chunks[0] += 1
+                    if n_chunks[0] % checkpoint_every == 0:
+                        if recorder:
+                            recorder.series.flush()
+                        self.write_checkpoint(checkpoint, trajs, counts, i, counter, n_frames, positions)
+            traj_counts, n_frames = self.traj_counts(traj, topo, atom_indices, counter, cutoff, chunk, cache,
+                                                     done=done, on_chunk=on_chunk, positions=positions,
+                                                     recorders=recorders)
+            counts += traj_counts
+            self.n_frames += n_frames
+            self.add_positions(positions)
+            if checkpoint:
+                self.write_checkpoint(checkpoint, trajs, counts, i+1)
+        self.atomic_counts = counts
+        self.close_series(recorder)
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def windows(self, length=1, step=None):
+        """Returns the networks averaged over windows of length blocks every step blocks
+        (default: non overlapping windows), from the blocks summed by create or 
+        create_atomic with block
+        Returns: list of AANet with the window average, window: (first frame, number of frames)"""
+        if not getattr(self, 'blocks', None):
+            raise ValueError('No blocks: create the network with block=<number of frames>')
+        networks = []
+        for first, n_frames, average in self.blocks.windows(length, step):
+            aanet = AANet()
+            aanet.id2label, aanet.n_residues, aanet.average = self.id2label, self.n_residues, average
+            aanet.n_frames, aanet.window = n_frames, (first, n_frames)
+            aanet.coords = getattr(self, 'coords', None)
+            networks.append(aanet)
+        return networks
+
+    def open_series(self, series, atom2res, n_frames=None):
+        """Returns a SeriesRecorder storing the residue contacts of each frame in the
+        folder series (None if series is None). The store is created, or truncated
+        to n_frames frames if given (resumed run)."""
+        if series is None:
+            return None
+        if n_frames is None:
+            labels = [self.id2label[i] for i in range(self.n_residues)]
+            store = ContactSeries.create(series, self.n_residues, labels, cutoff=self.cutoff, 
+                                         selection=self.selection)
+        else:
+            store = ContactSeries(series, mode='a')
+            store.truncate(n_frames)
+        return SeriesRecorder(store, atom2res)
+
+    def close_series(self, recorder):
+        """Writes the last frames of the store and opens it for reading as self.series"""
+        if recorder:
+            recorder.series.close()
+            self.series = ContactSeries(recorder.series.path)
+
+    def write_checkpoint(self, output, trajs, counts, cursor, counter=None, n_frames=0, positions=None):
+        """Saves the state of a create_atomic run: the counts of the completed 
+        trajectories, the partial counts of the current one and the cursor
+        Parameters: cursor: int: index of the current trajectory
+        counter: AtomicCounter, optional: partial counts of the current trajectory
+        n_frames: int: number of frames of the current trajectory in counter
+        positions: CoordinateAccumulator, optional: partial positions of the current trajectory"""
+        keys, values = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if counter is not None:
+            counter.flush()
+            keys, values = counter.keys, counter.values
+        partial_sum = positions.sum if positions is not None else np.zeros_like(self.coord_sum)
+        tmp = '{0}.{1}.tmp'.format(output, os.getpid())
+        write_contacts(tmp, counts, arrays={'keys': keys, 'values': values, 'coord_sum': self.coord_sum,
+                                            'partial_coord_sum': partial_sum}, kind='checkpoint',
+                       trajs=list(trajs), cutoff=self.cutoff, selection=self.selection, **self.search_params(),
+                       n_frames=int(self.n_frames), cursor=cursor, cursor_frames=int(n_frames))
+        os.replace(tmp, output)
+
+    def read_checkpoint(self, input, trajs):
+        """Reads a checkpoint written by write_checkpoint for the same run
+        Returns: counts: csr_matrix, n_frames: int, cursor: int, 
+        partial: (keys, values, n_frames, position sum) or None"""
+        counts, arrays, header = read_contacts(input, mmap=False)
+        params = {key: header[key] for key in ['pbc', 'neighbor'] if key in header}
+        if (header['trajs'], header['cutoff'], header['selection'], params) != \
+           (list(trajs), self.cutoff, self.selection, self.search_params()):
+            raise ValueError('Checkpoint {0} was written for other inputs'.format(input))
+        self.coord_sum, self.coord_frames = np.array(arrays['coord_sum']), header['n_frames']
+        partial = None
+        if header['cursor_frames']:
+            partial = (arrays['keys'], arrays['values'], header['cursor_frames'], 
+                       np.array(arrays['partial_coord_sum']))
+        print('Resuming from traj {0}, frame {1}'.format(header['cursor'], header['cursor_frames']))
+        return counts, header['n_frames'], header['cursor'], partial
+
+    @property
+    def atomic_avg(self):
+        """Average atomic contact matrix"""
+        return self.atomic_counts/self.n_frames
+
+    @atomic_avg.setter
+    def atomic_avg(self, value):
+        self.atomic_counts, self.n_frames = value, 1
+
+    def extend(self, traj, topo=None, start=0, stop=None, chunk=1000, cache=None, replica=None):
+        """Folds the contacts of new frames into an existing network (created with 
+        create or create_atomic, or loaded with load_residue or load_atomic) and 
+        renormalizes it, without recomputing the frames already counted.
+        Parameters: traj: str or list of str: path of the new trajectories or segments
+        topo: str, optional: path of topology to use, defaults to the one of the network
+        start, stop: int, optional: frame range of traj to add, defaults to all frames
+        chunk: int: number of frames loaded at once
+        cache: ContactCache or str, optional: cache of the per trajectory counts
+        replica: int, optional: index of the replica (sample of the resampling 
+        statistics) continued by the new frames. By default, the replica of the same
+        trajectory, or a new replica for a new trajectory.
+        """
+        trajs = [traj] if type(traj) == str else traj
+        topo = topo if topo else self.topology_path
+        cache = get_cache(cache)
+        if not hasattr(self, 'topology'):
+            self.topology = load_topology(self.topology_path)
+            if self.atom_indices is not None:
+                self.topology = self.topology.subset(self.atom_indices)
+        atomic = hasattr(self, 'atomic_counts')
+        #Positions are only followed if they were accumulated on the counted frames
+        weights = residue_weights(self.topology) if getattr(self, 'coords', None) is not None else None
+        for _traj in trajs:
+            if atomic:
+                counter = AtomicCounter(self.n_atoms)
+            else:
+                counter = ResidueCounter(atom2residue(self.topology), self.n_residues)
+            positions = CoordinateAccumulator(weights) if weights is not None else None
+            counts, n_frames = self.traj_counts(_traj, topo, self.atom_indices, counter, 
+                                                self.cutoff, chunk, cache, start, stop, positions=positions)
+            if atomic:
+                self.atomic_counts = self.atomic_counts + counts
+            else:
+                self.counts = self.counts + counts.toarray()
+                if hasattr(self, 'replicas'):
+                    self.add_replica(_traj, counts, n_frames, replica)
+            self.n_frames += n_frames
+            if positions:
+                self.add_positions(positions)
+        if not atomic:
+            self.average = self.counts/self.n_frames
+            self.label_net()
+
+    def add_replica(self, traj, counts, n_frames, replica=None):
+        """Folds the counts of frames of traj into the replica they continue (see extend)"""
+        if not hasattr(self, 'replica_trajs'):
+            self.replica_trajs = [None]*len(self.replicas)
+        if replica is None and traj in self.replica_trajs:
+            replica = self.replica_trajs.index(traj)
+        if replica is None:
+            self.replicas.append((counts, n_frames))
+            self.replica_trajs.append(traj)
+        else:
+            replica_counts, replica_frames = self.replicas[replica]
+            self.replicas[replica] = (replica_counts + counts, replica_frames + n_frames)
+
+    def contact_metadata(self):
+        """Returns the metadata stored along contact matrices"""
+        return dict(cutoff=getattr(self, 'cutoff', None), 
+                    selection=getattr(self, 'selection', None),
+                    n_frames=int(self.n_frames), 
+                    labels=[self.id2label[i] for i in range(len(self.id2label))],
+                    topology=getattr(self, 'topology_path', None), **self.search_params())
+
+    def search_params(self):
+        """Returns the parameters of the neighbor search other than the cutoff, as
+        stored in contact files and cache keys (empty for the default search). The
+        Verlet list gives the contacts of the KDTree except in triclinic boxes, where
+        pairs at the cutoff can be rounded differently, so it is recorded with pbc."""
+        if not getattr(self, 'pbc', False):
+            return {}
+        if getattr(self, 'neighbor', 'kdtree') != 'kdtree':
+            return {'pbc': True, 'neighbor': self.neighbor}
+        return {'pbc': True}
+
+    def set_contact_metadata(self, header):
+        """Sets the attributes stored in the header of a contact file"""
+        self.cutoff, self.selection = header['cutoff'], header['selection']
+        self.pbc, self.neighbor = header.get('pbc', False), header.get('neighbor', 'kdtree')
+        self.n_frames, self.n_residues = header['n_frames'], len(header['labels'])
+        self.id2label = dict(enumerate(header['labels']))
+        self.topology_path = header['topology']
+
+    def set_positions(self, arrays):
+        """Sets the mean residue positions stored along contact matrices, if any"""
+        if 'coord_sum' in arrays:
+            self.coord_sum, self.coord_frames = np.array(arrays['coord_sum']), self.n_frames
+            self.coords = (self.coord_sum/max(self.n_frames, 1)).astype(np.float32)
 
     def save_atomic(self, output):
-        """Saves atomic network to the desired output
+        """Saves atomic contact counts to the desired output in the contact file format
         Parameters: output: str, path where to output the file"""
-        nx.write_gpickle(self.atomic_avg, output)
+        write_contacts(output, self.atomic_counts, 
+                       arrays={'atom2res': atom2residue(self.topology),
+                               'atom_indices': self.atom_indices,
+                               'coord_sum': getattr(self, 'coord_sum', None)}, 
+                       kind='atomic', **self.contact_metadata())
 
-    def load_atomic(self, input):
-        """Loads atomic network
-        Parameters: output: str, path where to input the file"""
-        self.atomic_avg = nx.read_gpickle(input)
-    
+    def load_atomic(self, input, topo=None, mmap=True):
+        """Loads atomic network. Contact files are memory-mapped, so that several 
+        processes share the same pages, older pickles are unpickled.
+        Parameters: input: str, path where to input the file
+        topo: str, optional: path of the topology, if it moved since the file was saved
+        mmap: bool, optional: if False, arrays are read in memory"""
+        if not is_contact_file(input):
+            self.atomic_avg = nx.read_gpickle(input)
+            return
+        self.atomic_counts, arrays, header = read_contacts(input, mmap=mmap)
+        self.set_contact_metadata(header)
+        self.n_atoms, self.atom_indices = header['shape'][0], arrays.get('atom_indices')
+        self.set_positions(arrays)
+        if topo:
+            self.topology_path = topo
+        self.topology = md.load_topology(self.topology_path)
+        if self.atom_indices is not None:
+            self.topology = self.topology.subset(self.atom_indices)
+
+    def save_residue(self, output):
+        """Saves residue contact counts to the desired output in the contact file format
+        Parameters: output: str, path where to output the file"""
+        write_contacts(output, self.counts, arrays={'atom_indices': self.atom_indices,
+                                                    'coord_sum': getattr(self, 'coord_sum', None)},
+                       kind='residue', **self.contact_metadata())
+
+    def load_residue(self, input, mmap=True):
+        """Loads residue contact counts saved with save_residue and builds the network
+        Parameters: input: str, path where to input the file"""
+        counts, arrays, header = read_contacts(input, mmap=mmap)
+        self.set_contact_metadata(header)
+        self.atom_indices = arrays.get('atom_indices')
+        self.set_positions(arrays)
+        self.counts = counts.toarray()
+        self.average = self.counts/self.n_frames
+        self.label_net()
     
     def create_list(self, selectionList):
         """Function to apply to a atomic contact network and then builds from it a list of amino acid network
@@ -211,14 +985,12 @@ class AANet():
 
         def create_top(selection):
             selection = selection.replace("not hydrogen", "!(name =~'H.*')")
-            indexes = self.t.topology.select(selection)
-            top_mat = np.zeros((self.n_atoms, self.n_residues))        
-            for atom in self.t.topology.atoms:
-                if atom.index in indexes:
-                    top_mat[atom.index, atom.residue.index] = 1
-            top_mat = csr_matrix(top_mat)
+            indexes = self.topology.select(selection)
+            top_mat = csr_matrix((np.ones(len(indexes)), (indexes, atom2res[indexes])), 
+                                 shape=(self.n_atoms, self.n_residues))
             return top_mat
 
+        atom2res = atom2residue(self.topology)
         #Getting the atomic contacts
         networks = []
 
@@ -230,9 +1002,12 @@ class AANet():
             else:
                 T2=create_top(selection)
                 T1=T2.transpose()
-            mat = T1.dot(self.atomic_avg.dot(T2))
+            mat = T1.dot(self.atomic_counts.dot(T2))/self.n_frames
             net = nx.from_scipy_sparse_matrix(mat)
-            networks.append(nx.relabel_nodes(net, self.id2label, copy=False))
+            net = nx.relabel_nodes(net, self.id2label, copy=False)
+            if getattr(self, 'coords', None) is not None:
+                nx.set_node_attributes(net, self.positions(), 'coords')
+            networks.append(net)
         return networks
             
 
@@ -249,10 +1024,11 @@ class AANet():
         copy.remove_nodes_from(list(nx.isolates(copy)))
         return copy
 
-def create_aanet(traj, topo=None, selection='all', cutoff=5):
+def create_aanet(traj, topo=None, selection='all', cutoff=5, cache=None, pbc=False, neighbor='kdtree', skin=2):
     selection = selection.replace("not hydrogen", "!(name =~'H.*')")
     aanet = AANet()
-    aanet.create(traj, topo=topo, selection=selection, cutoff=cutoff)
+    aanet.create(traj, topo=topo, selection=selection, cutoff=cutoff, cache=cache, pbc=pbc, neighbor=neighbor,
+                 skin=skin)
     return aanet
 
 def load_aanet(input):
@@ -260,10 +1036,12 @@ def load_aanet(input):
     aanet.load(input)
     return aanet
 
-def create_aanet_multiselection(traj, selectionList, topo=None, selection='all', cutoff=5, output_atomic=None, output_list = None):
+def create_aanet_multiselection(traj, selectionList, topo=None, selection='all', cutoff=5, output_atomic=None, output_list = None, cache=None,
+                                checkpoint=None, resume=False, pbc=False, neighbor='kdtree', skin=2):
     selection = selection.replace("not hydrogen", "!(name =~'H.*')")
     aanet = AANet()
-    aanet.create_atomic(traj, baseSelection=selection, topo=topo, cutoff=cutoff, chunk=10000)
+    aanet.create_atomic(traj, baseSelection=selection, topo=topo, cutoff=cutoff, chunk=10000, cache=cache,
+                        checkpoint=checkpoint, resume=resume, pbc=pbc, neighbor=neighbor, skin=skin)
     if output_atomic:
         aanet.save_atomic(output_atomic)
     networks = aanet.create_list(selectionList)
@@ -272,6 +1050,24 @@ def create_aanet_multiselection(traj, selectionList, topo=None, selection='all',
             nx.write_gpickle(net, out)
     return networks
 
+def merge_aanets(aanets):
+    """Merges atomic networks computed on the same atoms (e.g. the replicas of a state)
+    into one network, as if create_atomic had been run on all their trajectories
+    Parameters: aanets: list of AANet with atomic counts
+    Returns: AANet"""
+    merged = AANet()
+    merged.__dict__.update(aanets[0].__dict__)
+    for aanet in aanets[1:]:
+        if aanet.atomic_counts.shape != merged.atomic_counts.shape:
+            raise ValueError('Atomic networks of {0} and {1} atoms cannot be merged'.format(
+                             merged.n_atoms, aanet.n_atoms))
+    merged.atomic_counts = sum(aanet.atomic_counts for aanet in aanets[1:]) + aanets[0].atomic_counts
+    merged.n_frames = sum(aanet.n_frames for aanet in aanets)
+    if all(getattr(aanet, 'coords', None) is not None for aanet in aanets):
+        merged.coord_sum = sum(aanet.coord_sum for aanet in aanets)
+        merged.coord_frames = merged.n_frames
+        merged.coords = (merged.coord_sum/merged.n_frames).astype(np.float32)
+    return merged
 
 if __name__ == '__main__':
 
@@ -1,6 +1,7 @@
 from pymol import cmd, stored
 from pymol.cgo import *
 import networkx as nx
+import numpy as np
 from Bio.PDB.Polypeptide import aa1, aa3
 three2one = dict(zip(aa3, aa1))
 t2o = lambda X: three2one[X] if X in three2one else X[0] 
@@ -9,6 +10,13 @@ selection = lambda X: " or resi "+X[3:-1]+" and n. CA or n. C"
 
 
 
+def cylinders(start, end, radius, color):
+    """Returns the CGO list of cylinders of a given color from arrays of start 
+    and end points and of radii, built in a single pass"""
+    n = len(radius)
+    return np.column_stack([np.full(n, CYLINDER), start, end, radius, 
+                            np.tile(color, (n, 2))]).ravel().tolist()
+
 def drawNetwork(path, userSelection='all', r=1, edge_norm=None, alpha=0.5, 
                 node_color=(0.6, 0.6, 0.6), edge_color1 = (1, 0, 0), 
                 edge_color2 = (0, 0, 1), labelling='0',
@@ -47,32 +55,30 @@ def drawNetwork(path, userSelection='all', r=1, edge_norm=None, alpha=0.5,
     #     cmd.label(selection=selnodes, expression="resn+resi")
     # cmd.load_cgo(obj, 'nodes')
 
+    #Edge arrays, read once from the graph
+    edges = list(net.edges(data=True))
+    weights = np.array([d['weight'] for _, __, d in edges], dtype=float)
     if edge_norm == None:
-        edge_norm = max([net.edges()[(u, v)]['weight'] for u, v in net.edges()])/r
-    obj1, obj2, nodelist = [], [], []
-    for u, v in net.edges():
-        radius = net[u][v]['weight']/edge_norm
-        if abs(net[u][v]['weight']) >= threshold:
-            if 'color' in net[u][v]: 
-                if net[u][v]['color'] == 'r':
-                    obj1+=[CYLINDER, *node2CA[u], *node2CA[v], radius, *edge_color1, *edge_color1]
-                else:
-                    obj2+=[CYLINDER, *node2CA[u], *node2CA[v], radius, *edge_color2, *edge_color2]
-            else:
-                if net[u][v]['weight'] <= 0:
-                    obj1+=[CYLINDER, *node2CA[u], *node2CA[v], radius, *edge_color1, *edge_color1]
-                else:
-                    obj2+=[CYLINDER, *node2CA[u], *node2CA[v], radius, *edge_color2, *edge_color2]
-
-            nodelist+=[u, v]
+        edge_norm = max(weights)/r
+    if len(edges) and 'color' in edges[0][2]:
+        first = np.array([d['color'] == 'r' for _, __, d in edges], dtype=bool)
+    else:
+        first = weights <= 0
+    keep = np.abs(weights) >= threshold
+    nodelist = list(dict.fromkeys(node for (u, v, _), k in zip(edges, keep) if k for node in (u, v)))
+    index = dict(zip(nodelist, range(len(nodelist))))
+    coords = np.array([node2CA[u] for u in nodelist], dtype=float).reshape(-1, 3)
+    row = np.array([index[u] for (u, _, __), k in zip(edges, keep) if k], dtype=int)
+    col = np.array([index[v] for (_, v, __), k in zip(edges, keep) if k], dtype=int)
+    radii, first = weights[keep]/edge_norm, first[keep]
+    obj1 = cylinders(coords[row[first]], coords[col[first]], radii[first], edge_color1)
+    obj2 = cylinders(coords[row[~first]], coords[col[~first]], radii[~first], edge_color2)
 
     #Drawing nodes
-    obj=[COLOR, *node_color]
-    nodelist = set(nodelist)
+    obj = [COLOR, *node_color]
     selnodes = ''.join([node2id[u] for u in nodelist])[4:]
-    for u in nodelist:
-        x, y, z = node2CA[u]
-        obj+=[SPHERE, x, y, z, r]
+    obj += np.column_stack([np.full(len(coords), SPHERE), coords, 
+                            np.full(len(coords), r)]).ravel().tolist()
 
     if labelling=='1':
         cmd.label(selection=selnodes, expression="t2o(resn)+resi")
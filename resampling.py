@@ -0,0 +1,68 @@
+"""Resampling statistics of perturbation weights.
+The samples of a network (replicas or blocks of frames) are given as a (samples,
+edges) array of contact counts and the number of frames of each sample, the
+weight of a network being the pooled average sum(counts)/sum(frames). The
+perturbation weight of an edge is the difference of the weights of two networks.
+Resamplings are expressed as (resamplings, samples) weight matrices, so that all
+the edges are resampled at once with matrix products, by blocks of edges to
+bound memory."""
+import numpy as np
+from scipy.special import erfc
+
+BLOCK_BYTES = 2**26
+
+def pooled(values, frames, weights):
+    """Returns the (resamplings, edges) pooled averages of the samples weighted by
+    weights, of shape (resamplings, samples)"""
+    return (weights @ values)/(weights @ frames)[:, None]
+
+def bootstrap_difference(values1, frames1, values2, frames2, n_samples=1000, seed=None):
+    """Bootstrap distribution of the perturbation weights: the samples of each network
+    are drawn with replacement n_samples times
+    Parameters: values1, values2: np.array of shape (samples, edges): contact counts
+    of the samples of each network on the same edges
+    frames1, frames2: np.array of shape (samples,): number of frames of each sample
+    n_samples: int: number of bootstrap resamplings
+    seed: int, optional: seed of the random generator
+    Returns: mean, std, pvalue: np.arrays of shape (edges,). The p-value is the
+    two-sided bootstrap probability that the perturbation weight has the other sign."""
+    rng = np.random.default_rng(seed)
+    k1, k2 = len(frames1), len(frames2)
+    #Number of times each sample is drawn in each resampling
+    weights1 = rng.multinomial(k1, np.full(k1, 1/k1), size=n_samples).astype(float)
+    weights2 = rng.multinomial(k2, np.full(k2, 1/k2), size=n_samples).astype(float)
+    n_edges = values1.shape[1]
+    mean, std, pvalue = np.zeros(n_edges), np.zeros(n_edges), np.ones(n_edges)
+    block = max(1, BLOCK_BYTES // (8*n_samples))
+    for start in range(0, n_edges, block):
+        stop = min(start + block, n_edges)
+        diff = pooled(values2[:, start:stop], frames2, weights2) - pooled(values1[:, start:stop], frames1, weights1)
+        mean[start:stop] = diff.mean(axis=0)
+        std[start:stop] = diff.std(axis=0, ddof=1)
+        below = (np.count_nonzero(diff <= 0, axis=0) + 1)/(n_samples + 1)
+        above = (np.count_nonzero(diff >= 0, axis=0) + 1)/(n_samples + 1)
+        pvalue[start:stop] = np.minimum(1, 2*np.minimum(below, above))
+    return mean, std, pvalue
+
+def jackknife_difference(values1, frames1, values2, frames2):
+    """Jackknife distribution of the perturbation weights: each sample is left out in
+    turn, the variances of both networks being added
+    Parameters: see bootstrap_difference, each network needs at least 2 samples
+    Returns: mean, std, pvalue: np.arrays of shape (edges,). The p-value is the
+    two-sided p-value of the normal approximation."""
+    var = np.zeros(values1.shape[1])
+    for values, frames in ((values1, frames1), (values2, frames2)):
+        k = len(frames)
+        if k < 2:
+            raise ValueError('The jackknife needs at least 2 samples per network, not {0}'.format(k))
+        block = max(1, BLOCK_BYTES // (8*k))
+        for start in range(0, values.shape[1], block):
+            _values = values[:, start:start+block]
+            #Leave-one-out weights: every sample but one
+            leave = (_values.sum(axis=0) - _values)/(frames.sum() - frames)[:, None]
+            var[start:start+block] += (k - 1)/k*np.sum((leave - leave.mean(axis=0))**2, axis=0)
+    mean = values2.sum(axis=0)/frames2.sum() - values1.sum(axis=0)/frames1.sum()
+    std = np.sqrt(var)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pvalue = np.where(std > 0, erfc(np.abs(mean)/(std*np.sqrt(2))), (mean == 0).astype(float))
+    return mean, std, pvalue
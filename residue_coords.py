@@ -0,0 +1,92 @@
+"""Residue coordinate index of a structure: the CA coordinates of its residues as
+an (N, 3) float32 array with a label -> row map, labels being formatted as in the
+networks ('A12:X', one letter code, residue number and chain). The index is built
+once per structure and cached next to the PDB file, keyed on the file hash."""
+import hashlib
+import numpy as np
+from maker import t2o
+
+#Rows are the x and y axes of the 2D projection of IGPS in our classical view
+IGPS_PROJECTION = np.array([[0.9980297273, 0.0236149631, 0.05812914],
+                            [0.1822020302, 0.6987674421, -0.6917560857]])
+
+def file_hash(path):
+    """Returns the sha1 of a file"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def pdb_parser():
+    """Returns a Bio.PDB PDBParser ignoring construction warnings"""
+    from Bio.PDB import PDBParser
+    from Bio.PDB.PDBExceptions import PDBConstructionWarning
+    import warnings
+    warnings.simplefilter('ignore', PDBConstructionWarning)
+    return PDBParser()
+
+class ResidueCoords():
+    """CA coordinates of the residues of a structure
+    Parameters: labels: list of str: label of each residue
+    coords: np.array of shape (N, 3): CA coordinates
+    chains: list of str, optional: chain of each residue
+    """
+    def __init__(self, labels, coords, chains=None):
+        self.labels = list(labels)
+        self.coords = np.asarray(coords, dtype=np.float32).reshape(-1, 3)
+        self.chains = np.asarray(chains if chains is not None else ['']*len(self.labels))
+        self.index = dict(zip(self.labels, range(len(self.labels))))
+
+    @classmethod
+    def from_pdb(cls, pdb_path, cache=True):
+        """Builds the index of a PDB file, or reads it from its cache file
+        (pdb_path + '.ca.npz') if the PDB file did not change"""
+        sha, cache_path = file_hash(pdb_path), pdb_path+'.ca.npz'
+        if cache:
+            try:
+                with np.load(cache_path) as saved:
+                    if str(saved['sha1']) == sha:
+                        return cls(saved['labels'].tolist(), saved['coords'], saved['chains'])
+            except (OSError, KeyError, ValueError):
+                pass
+        structure = pdb_parser().get_structure('X', pdb_path)[0]
+        labels, coords, chains = [], [], []
+        for atom in structure.get_atoms():
+            if atom.id == 'CA':
+                residue = atom.parent
+                labels.append(t2o(residue.resname)+str(residue.id[1])+':'+residue.parent.id)
+                coords.append(atom.coord)
+                chains.append(residue.parent.id)
+        index = cls(labels, coords, chains)
+        if cache:
+            try:
+                np.savez(cache_path, sha1=sha, labels=np.array(labels), coords=index.coords,
+                         chains=np.array(chains))
+            except OSError:
+                pass
+        return index
+
+    def take(self, labels):
+        """Returns the (len(labels), 3) coordinates of the given residues"""
+        return self.coords[[self.index[label] for label in labels]]
+
+    def project(self, matrix=IGPS_PROJECTION):
+        """Returns the (N, 2) linear projection of the coordinates
+        Parameters: matrix: np.array of shape (2, 3): rows are the x and y axes"""
+        return self.coords.astype(float) @ np.asarray(matrix).T
+
+    def project_OXY(self, O, X, Y):
+        """Returns the (N, 2) positions of the residues in the O X Y frame: x and y
+        are the distances to the lines OX and OY"""
+        O = np.asarray(O, dtype=float)
+        axes = np.array([O - np.asarray(X, dtype=float), O - np.asarray(Y, dtype=float)])
+        axes /= np.linalg.norm(axes, axis=1)[:, None]
+        AO = O - self.coords.astype(float)
+        #|AO x u|^2 = |AO|^2 - (AO.u)^2 for a unit vector u
+        along = AO @ axes.T
+        return np.sqrt(np.maximum(np.sum(AO**2, axis=1)[:, None] - along**2, 0))
+
+    def positions(self, xy):
+        """Returns a dict label -> position from an array of positions"""
+        return dict(zip(self.labels, map(tuple, np.asarray(xy).tolist())))